@@ -93,7 +93,7 @@ class PRIMME(nn.Module):
         with h5py.File(h5_path, 'r') as f:
             print(f.keys())
             ims_id = f['ims_id'][:]
-            miso_array = f['miso_array'][:]
+            miso_array = fs.read_trainset_miso(f, slice(n_samples))
         self.im_seq_T = torch.from_numpy(ims_id[:n_samples, :n_step])
         self.miso_array_T = miso_array[:n_samples]
         self.seq_samples = list(np.arange(len(self.im_seq_T)))
@@ -306,7 +306,6 @@ def train_primme(trainset, n_step, n_samples, mode = "Single_Step", num_eps=25,
                    num_dims=dims, mode = mode, device = device).to(device)    
 
     agent.load_data(h5_path=trainset, n_step=n_step, n_samples=n_samples)
-    append_name = trainset.split('_kt')[0].split("spparks_")[1]
     modelname = ''
     
     for epoch in tqdm(range(1, num_eps+1), desc='Epochs', leave=True):  
@@ -323,7 +322,9 @@ def train_primme(trainset, n_step, n_samples, mode = "Single_Step", num_eps=25,
     return modelname
 
 
-def run_primme(ic, ea, miso_array, miso_matrix, nsteps, ic_shape, modelname, pad_mode='circular',  mode = "Single_Step", if_plot=False):
+def run_primme(ic, ea, miso_array, nsteps, ic_shape, modelname, pad_mode='circular',  mode = "Single_Step", if_plot=False, if_delta=False, key_freq=10):
+    # "if_delta" - stream "ims_id" to the file during the simulation as keyframes every "key_freq" steps plus the pixels flipped by each step (see "fs.DeltaFrameWriter")
+    #   only boundary pixels change between steps, so the file is much smaller and frames are not kept in memory ("ims_id" is returned as None), read it with "fs.read_ims_id"
     
     # Setup
     agent = PRIMME(pad_mode=pad_mode, mode = mode, device = device).to(device)
@@ -339,17 +340,6 @@ def run_primme(ic, ea, miso_array, miso_matrix, nsteps, ic_shape, modelname, pad
     sz_str = ''.join(['%dx'%i for i in size])[:-1]
     fp_save = './data/primme_sz(%s)_ng(%d)_nsteps(%d)_freq(1)_kt%s'%(sz_str,ngrain,nsteps,append_name)
     
-    # Run simulation
-    agent.eval()
-    with torch.no_grad():    
-        ims_id = im
-        for _ in tqdm(range(nsteps), 'Running PRIMME simulation: '):
-            im = agent.step(im.clone().to(device))
-            ims_id = torch.cat([ims_id, im.detach().cpu()])
-            if if_plot: plt.imshow(im[0,0,].detach().cpu().numpy()); plt.show()
-    ims_id = ims_id.cpu().numpy()
-    
-    # Save Simulation
     with h5py.File(fp_save, 'w') as f:
         
         # If file already exists, create another group in the file for this simulaiton
@@ -357,15 +347,34 @@ def run_primme(ic, ea, miso_array, miso_matrix, nsteps, ic_shape, modelname, pad
         hp_save = 'sim%d'%num_groups
         g = f.create_group(hp_save)
         
+        # Run simulation, the misorientations of neighboring grains are stored as new boundaries appear (instead of the dense "miso_array")
+        if if_delta: writer = fs.DeltaFrameWriter(g, "ims_id", ic[None,], dtype, key_freq)
+        miso_sparse = fs.SparseMiso(ea, miso_array=miso_array)
+        miso_sparse.add_image(im.long(), pad_mode=pad_mode)
+        agent.eval()
+        with torch.no_grad():    
+            ims_id = im
+            for _ in tqdm(range(nsteps), 'Running PRIMME simulation: '):
+                im_next = agent.step(im.clone().to(device))
+                if if_delta: 
+                    indx = agent.indx_use[im_next.flatten()[agent.indx_use]!=im.to(device).flatten()[agent.indx_use]] #only flipped pixels leave the device
+                    writer.append(indx.cpu().numpy(), im_next.flatten()[indx].cpu().numpy())
+                else: ims_id = torch.cat([ims_id, im_next.detach().cpu()])
+                im = im_next
+                miso_sparse.add_image(im.long(), pad_mode=pad_mode)
+                if if_plot: plt.imshow(im[0,0,].detach().cpu().numpy()); plt.show()
+        
         # Save data
-        dset = g.create_dataset("ims_id", shape=ims_id.shape, dtype=dtype)
-        dset2 = g.create_dataset("euler_angles", shape=ea.shape)
-        dset3 = g.create_dataset("miso_array", shape=miso_array.shape)
-        dset4 = g.create_dataset("miso_matrix", shape=miso_matrix.shape)
-        dset[:] = ims_id
+        if if_delta: 
+            writer.close()
+            ims_id = None
+        else:
+            ims_id = ims_id.cpu().numpy()
+            dset = fs.create_h5_dataset(g, "ims_id", shape=ims_id.shape, dtype=dtype, sample_dims=1) #one frame per chunk
+            dset[:] = ims_id
+        dset2 = fs.create_h5_dataset(g, "euler_angles", shape=ea.shape, dtype='float32')
         dset2[:] = ea
-        dset3[:] = miso_array #radians (does not save the exact "Miso.txt" file values, which are degrees divided by the cutoff angle)
-        dset4[:] = miso_matrix #same values as mis0_array, different format
+        miso_sparse.save(g) #radians, same values as miso_array
 
     return ims_id, fp_save
 
@@ -379,7 +388,7 @@ def sample_data(h5_path = "./data/trainset_spparks_sz(257x257)_ng(256-256)_nsets
         i_max = f['ims_id'].shape[0]
         i_batch = np.sort(np.random.randint(low=0, high=i_max, size=(batch_size,)))
         batch = f['ims_id'][i_batch,]
-        miso_array = f['miso_array'][i_batch,] 
+        miso_array = fs.read_trainset_miso(f, i_batch)
     
     im_seq = torch.from_numpy(batch[0,].astype(float)).to(device)
     miso_array = torch.from_numpy(miso_array.astype(float)).to(device)
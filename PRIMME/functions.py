@@ -19,7 +19,16 @@ from unfoldNd import unfoldNd
 #from PRIMME import PRIMME
 import matplotlib.colors as mcolors
 import pickle
+import hashlib
+import json
+import shutil
+import multiprocessing
+import itertools
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from PIL import Image, GifImagePlugin
 ### Script
 
 __location__ = os.path.realpath(os.path.join(os.getcwd(), os.path.dirname(__file__)))   
@@ -87,6 +96,85 @@ def load_picke_files(load_dir, filename_save):
     
     return dataset
 
+### HDF5 storage
+h5_storage = {'compression': 'lzf', 'compression_opts': None, 'shuffle': True, 'max_chunk_mb': 4, 'grow_chunk_kb': 256} #default storage policy for "create_h5_dataset", e.g. 'compression': 'gzip', 'compression_opts': 1
+
+
+def h5_chunks(shape, itemsize, sample_dims=1, max_chunk_mb=4, maxshape=None, grow_chunk_kb=256):
+    #Chunk shape holding one sample (a frame, an initial condition, a training set...) indexed by the first "sample_dims" dimensions
+    #Other dimensions that can grow (None in "maxshape", e.g. records appended as they are found) get about "grow_chunk_kb" per chunk, whatever their current size
+    #The remaining dimensions are halved, largest first, until a chunk is no larger than "max_chunk_mb"
+    chunks = [1]*sample_dims + [max(1, int(s)) for s in shape[sample_dims:]]
+    if maxshape!=None:
+        for i in range(sample_dims, len(shape)):
+            if maxshape[i]==None: 
+                chunks[i] = 1
+                chunks[i] = max(1, int(grow_chunk_kb*2**10/itemsize/np.prod(chunks)))
+    while np.prod(chunks)*itemsize > max_chunk_mb*2**20:
+        i = int(np.argmax(chunks))
+        if chunks[i]==1: break
+        chunks[i] = (chunks[i]+1)//2
+    return tuple(chunks)
+
+
+def h5_sample_dims(shape, itemsize):
+    #Default "sample_dims" for "h5_chunks", arrays of images or rows of at least 4 KB are read one along the first dimension at a time
+    if len(shape)>=3 or (len(shape)==2 and shape[1]*itemsize>=4096): return 1
+    return 0
+
+
+def create_h5_dataset(g, name, shape=None, dtype=None, data=None, maxshape=None, sample_dims=None, storage=None):
+    #Creates dataset "name" in h5 group "g" with the storage policy "storage" ("h5_storage" if not given), recorded in its 'storage' attribute
+    #Chunks follow the access pattern (see "h5_chunks", "sample_dims" from "h5_sample_dims" if not given) and are compressed losslessly
+    #"shuffle" + "lzf" suits ID images (few distinct high bytes) and is fast enough for per frame reads and writes
+    
+    if storage==None: storage = h5_storage
+    if data is not None: 
+        data = np.asarray(data)
+        shape = data.shape
+        if dtype is None: dtype = data.dtype
+    dtype = np.dtype(dtype if dtype is not None else 'float32') #a numpy dtype compares equal to None when float64
+    if name.split('/')[-1]=='ims_id': frame_cache.clear(g.file.filename) #frames cached from a run this replaces, "name" can be a path (e.g. 'sim0/ims_id')
+    if len(shape)==0 or (np.prod(shape)==0 and maxshape==None): return g.create_dataset(name, shape=shape, dtype=dtype, data=data) #scalars and empty arrays, nothing to chunk
+    
+    if sample_dims==None: sample_dims = h5_sample_dims(shape, dtype.itemsize)
+    chunks = h5_chunks(shape, dtype.itemsize, sample_dims, storage['max_chunk_mb'], maxshape, storage['grow_chunk_kb'])
+    d = g.create_dataset(name, shape=shape, dtype=dtype, data=data, maxshape=maxshape, chunks=chunks, 
+                         compression=storage['compression'], compression_opts=storage['compression_opts'], shuffle=storage['shuffle'])
+    d.attrs['storage'] = json.dumps({'chunks': list(chunks), 'compression': storage['compression'], 'compression_opts': storage['compression_opts'], 'shuffle': storage['shuffle']})
+    return d
+
+
+def convert_h5(fp, fp_out=None, storage=None, block_mb=256):
+    #Rewrites every dataset of h5 file "fp" with "create_h5_dataset" (e.g. files written before it existed), groups and attributes are kept
+    #Written to "fp_out", or replaces "fp" once complete, datasets are copied "block_mb" at a time
+    
+    fp_tmp = fp_out if fp_out!=None else fp + '.tmp'
+    with h5py.File(fp, 'r') as fi, h5py.File(fp_tmp, 'w') as fo:
+        for k, v in fi.attrs.items(): fo.attrs[k] = v
+        
+        def copy(name, obj):
+            if isinstance(obj, h5py.Group):
+                go = fo.require_group(name)
+                for k, v in obj.attrs.items(): go.attrs[k] = v
+                return
+            go = fo.require_group(os.path.dirname(name) or '/')
+            if obj.shape==None or obj.shape==() or obj.size==0: fi.copy(obj, go, os.path.basename(name)) #scalars and empty datasets as they are
+            else:
+                maxshape = None if obj.maxshape==obj.shape else obj.maxshape
+                d = create_h5_dataset(go, os.path.basename(name), shape=obj.shape, dtype=obj.dtype, maxshape=maxshape, storage=storage)
+                rows = max(1, int(block_mb*2**20/(obj.size/obj.shape[0]*obj.dtype.itemsize)))
+                for i in range(0, obj.shape[0], rows): d[i:i+rows] = obj[i:i+rows]
+            for k, v in obj.attrs.items(): 
+                if k!='storage': fo[name].attrs[k] = v
+        
+        fi.visititems(copy)
+    
+    if fp_out==None: os.replace(fp_tmp, fp)
+    print("FILE CONVERTED: %s"%(fp_out if fp_out!=None else fp))
+    return fp_out if fp_out!=None else fp
+
+
 ### Create initial conditions
 
 def generate_random_grain_centers(size=[128, 64, 32], ngrain=512):
@@ -147,9 +235,9 @@ def generate_hex_grain_centers(dim=512, dim_ngrain=8):
     return grain_centers, size
 
 
-def generate_hexIC():
+def generate_hexIC(device=device):
     grain_centers, size = generate_hex_grain_centers(dim=512, dim_ngrain=8)
-    ic, ea, _ = voronoi2image(size=size, ngrain=64, center_coords0=grain_centers)
+    ic, ea, _ = voronoi2image(size=size, ngrain=64, center_coords0=grain_centers, device=device)
     return ic, ea
 
 
@@ -242,30 +330,179 @@ def voronoi2image(size=[128, 64, 32], ngrain=512, memory_limit=1e9, p=2, center_
         print("Available Memory: %d - Increase memory limit"%available_memory)
         return None, None, None
 
-def generate_train_init(filename, grain_shape, grain_sizes, device, miso_array = None):
+def generate_ic(grain_shape, grain_sizes, device, seed=None):
+    #Generates an initial condition of type "grain_shape" ("grain", "circular", "square" or "hex")
+    #"seed" makes the initial condition reproducible, the torch and numpy random states of the caller are restored afterwards
+    
+    if seed!=None: 
+        np_state = np.random.get_state()
+        with torch.random.fork_rng(devices=range(torch.cuda.device_count())): 
+            torch.manual_seed(seed)
+            np.random.seed(seed)
+            try: return generate_ic(grain_shape, grain_sizes, device)
+            finally: np.random.set_state(np_state)
     
     if grain_shape == "circular": 
         ic, ea = generate_circleIC(size = grain_sizes[0], r = grain_sizes[1]) #nsteps=200, pad_mode='circular'
     elif grain_shape == "square":
         ic, ea = generate_SquareIC(size = grain_sizes[0], r = grain_sizes[1]) 
     elif grain_shape == "hex":
-        ic, ea = generate_hexIC() #nsteps=500, pad_mode='circular'
+        ic, ea = generate_hexIC(device=device) #nsteps=500, pad_mode='circular'
     elif grain_shape == "grain":
         if grain_sizes[0][0] * grain_sizes[0][0] > 2024 * 2024:
             device = 'cpu'
         ic, ea, _ = voronoi2image(size = grain_sizes[0], ngrain = grain_sizes[1], device = device) #nsteps=500, pad_mode='circular'
+    else: 
+        raise Exception('Unknown grain shape: %s'%grain_shape)
+    
+    return ic, ea
+
+
+def generate_train_init(grain_shape, grain_sizes, device, miso_array=None, seed=None):
+    #Generates an initial condition ("ic"), its euler angles ("ea") and misorientations ("miso_array")
+    
+    ic, ea = generate_ic(grain_shape, grain_sizes, device, seed=seed)
+    if np.all(miso_array==None): miso_array = find_misorientation_cached(ea, mem_max=1) 
+    
+    return ic, ea, miso_array
+
+
+def _generate_ic_worker(inputs):
+    #Generates one member of an initial condition ensemble (runs in a worker process of "generate_ic_ensemble")
+    i, grain_shape, grain_sizes, seed = inputs
+    torch.set_num_threads(1) #one thread per worker, the pool provides the parallelism
+    ic, ea = generate_ic(grain_shape, grain_sizes, 'cpu', seed=seed)
+    miso_array = find_misorientation(ea, mem_max=1, device='cpu')
+    return i, ic, ea, miso_array
+
+
+def generate_ic_ensemble(grain_shape, grain_sizes, nics=200, seed=0, num_workers=None, fp=None):
+    #Generates "nics" initial conditions in parallel and writes them to a single h5 file
+    #Each initial condition "i" is generated with its own sub-seed from "seed", so the ensemble is reproducible regardless of "num_workers"
+    #The file has one chunk per initial condition: "ims_id" (nics, 1, dim1, dim2), "euler_angles" (nics, ngrain, 3), "miso_array" (nics, ngrain*(ngrain-1)/2)
+    
+    if fp==None: 
+        sz_str = ''.join(['%dx'%i for i in grain_sizes[0]])[:-1]
+        fp = './data/ensemble_%s_sz(%s)_ng(%d)_nics(%d)_seed(%d).h5'%(grain_shape, sz_str, grain_sizes[1], nics, seed)
+    if num_workers==None: num_workers = os.cpu_count()
+    
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(nics)]
+    
+    with h5py.File(fp, 'w') as f:
+        f.attrs['grain_shape'] = grain_shape
+        f.attrs['seed'] = seed
+        create_h5_dataset(f, 'seeds', data=np.array(seeds))
+        dsets = []
+        
+        def write(i, ic, ea, miso_array):
+            if len(dsets)==0: #shapes are known from the first initial condition returned
+                tmp = np.array([8,16,32], dtype='uint64')
+                dtype = 'uint' + str(tmp[np.sum(ea.shape[0]>2**tmp)])
+                dsets.append(create_h5_dataset(f, "ims_id", shape=(nics, 1)+ic.shape, dtype=dtype, sample_dims=1))
+                dsets.append(create_h5_dataset(f, "euler_angles", shape=(nics,)+ea.shape, dtype=ea.dtype, sample_dims=1))
+                dsets.append(create_h5_dataset(f, "miso_array", shape=(nics,)+miso_array.shape, dtype=miso_array.dtype, sample_dims=1))
+            dsets[0][i,0] = ic
+            dsets[1][i] = ea
+            dsets[2][i] = miso_array
+        
+        # Every member is generated in the pool, nothing is generated in this process before it forks (e.g. CUDA cannot be used in forked workers)
+        inputs = [(i, grain_shape, grain_sizes, seeds[i]) for i in range(nics)]
+        with multiprocessing.Pool(num_workers) as pool: 
+            for outputs in tqdm(pool.imap_unordered(_generate_ic_worker, inputs), 'Generating initial conditions', total=nics):
+                write(*outputs) #the main process is the only writer
+    
+    print("ENSEMBLE WRITTEN TO FILE: %s"%fp)
+    return fp
+
+
+### Initial condition cache
+#Initial conditions are stored in "cache_dir" under a hash of every parameter used to generate them
+#Each entry is a folder of ".npy" files that are memory mapped when loaded, least recently used entries are evicted first
+
+def ic_cache_key(grain_shape, grain_sizes, device, seed, miso_array=None):
+    #Returns a hash of all of the parameters that define an initial condition
+    params = {"grain_shape": grain_shape, 
+              "grain_sizes": np.array(grain_sizes, dtype=object).tolist(), 
+              "device": torch.device(device).type, 
+              "seed": seed}
+    if not np.all(miso_array==None): 
+        params["miso_array"] = hashlib.sha1(np.ascontiguousarray(miso_array).tobytes()).hexdigest()
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest(), params
+
+
+def dir_size(path):
+    #Returns the total size of all files in "path" in bytes
+    path = Path(path)
+    if path.is_file(): return path.stat().st_size
+    return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+
+def evict_cache(cache_dir='./data/ic_cache/', max_gb=10):
+    #Removes the least recently used entries (files or folders) in "cache_dir" until it is smaller than "max_gb"
+    
+    cache_dir = Path(cache_dir)
+    if not cache_dir.exists(): return
+    entries = sorted([e for e in cache_dir.iterdir() if e.suffix!='.tmp'], key=lambda e: e.stat().st_mtime)
+    sizes = [dir_size(e) for e in entries]
+    total = sum(sizes)
+    for e, sz in zip(entries, sizes):
+        if total<=max_gb*1e9: break
+        if e.is_dir(): shutil.rmtree(e)
+        else: e.unlink()
+        total -= sz
+        print("CACHE ENTRY EVICTED: %s"%e)
+
+
+def save_ic_cache(key, params, arrays, cache_dir='./data/ic_cache/', max_gb=10):
+    #Writes each array in the dictionary "arrays" to "cache_dir/key/<name>.npy" along with "params.json"
+    
+    path = Path(cache_dir).joinpath(key)
+    path_tmp = Path(cache_dir).joinpath(key + '.tmp')
+    if path_tmp.exists(): shutil.rmtree(path_tmp)
+    path_tmp.mkdir(parents=True)
+    for name, a in arrays.items(): 
+        np.save(path_tmp.joinpath(name + '.npy'), np.asarray(a))
+    with open(path_tmp.joinpath('params.json'), 'w') as f: 
+        json.dump(params, f, sort_keys=True)
+    if path.exists(): shutil.rmtree(path)
+    os.replace(path_tmp, path) #only complete entries are ever visible in the cache
+    print("IC CACHED: %s"%path)
+    
+    evict_cache(cache_dir, max_gb)
+
+
+def load_ic_cache(key, names, cache_dir='./data/ic_cache/'):
+    #Returns a dictionary of memory mapped arrays from "cache_dir/key", or None if the entry does not exist
+    
+    path = Path(cache_dir).joinpath(key)
+    if not all(path.joinpath(name + '.npy').is_file() for name in names): return None
+    os.utime(path) #mark as recently used
+    print("LOADING CACHED IC: %s"%path)
+    return {name: np.load(path.joinpath(name + '.npy'), mmap_mode='c') for name in names}
+
+
+def load_or_generate_ic(grain_shape, grain_sizes, device, seed=0, miso_array=None, cache_dir='./data/ic_cache/', max_gb=10):
+    #Loads the initial condition defined by these parameters from the cache, or generates and caches it
+    #If "seed" is None the initial condition is not reproducible, so it is generated and not cached
     
-    if np.all(miso_array==None): miso_array = find_misorientation(ea, mem_max=1) 
-    miso_matrix = miso_conversion(torch.from_numpy(miso_array[None,]))[0]    
+    if seed==None: return generate_train_init(grain_shape, grain_sizes, device, miso_array=miso_array)
     
-    data_dict = {"ic": ic, "ea": ea, "miso_array": miso_array, "miso_matrix": miso_matrix}
-    save_picke_files(save_dir = Path('./data'), filename_save = filename, dataset = data_dict)
+    key, params = ic_cache_key(grain_shape, grain_sizes, device, seed, miso_array)
+    names = ["ic", "ea", "miso_array"]
+    arrays = load_ic_cache(key, names, cache_dir)
     
-    return ic, ea, miso_array, miso_matrix 
+    if arrays==None: 
+        ic, ea, miso_array = generate_train_init(grain_shape, grain_sizes, device, miso_array=miso_array, seed=seed)
+        save_ic_cache(key, params, {"ic": ic, "ea": ea, "miso_array": miso_array}, cache_dir, max_gb)
+    else: 
+        ic, ea, miso_array = [arrays[name] for name in names]
+    
+    return ic, ea, miso_array
+
 
 ### Run and read SPPARKS
 
-def image2init(img, EulerAngles, fp=None):
+def image2init(img, EulerAngles, fp=None, block_size=2**20):
     '''
     Takes an image of grain IDs (and euler angles assigned to each ID) and writes it to an init file for a SPPARKS simulation
     The initial condition file is written to the 2D or 3D file based on the dimension of 'img'
@@ -273,36 +510,30 @@ def image2init(img, EulerAngles, fp=None):
     Inputs:
         img (numpy, integers): pixels indicate the grain ID of the grain it belongs to
         EulerAngles (numpy): number of grains by three Euler angles
+        block_size: about how many sites are formatted and written at a time
     '''
     # Set local variables
+    img = np.asarray(img)
     size = img.shape
-    dim = len(img.shape)
     if fp==None: fp = r"./spparks_simulations/spparks.init"
-    IC = [0]*(np.prod(size)+3)
-    
-    # Write the information in the SPPARKS format and save the file
-    IC[0] = '# This line is ignored\n'
-    IC[1] = 'Values\n'
-    IC[2] = '\n'
-    k=0
-    
-    if dim==3: 
-        for i in range(0,size[2]):
-            for j in range(0,size[1]):
-                for h in range(0,size[0]):
-                    SiteID = int(img[h,j,i])
-                    IC[k+3] = str(k+1) + ' ' + str(int(SiteID+1)) + ' ' + str(EulerAngles[SiteID,0]) + ' ' + str(EulerAngles[SiteID,1]) + ' ' + str(EulerAngles[SiteID,2]) + '\n'
-                    k = k + 1
     
-    else:
-        for i in range(0,size[1]):
-            for j in range(0,size[0]):
-                SiteID = int(img[j,i])
-                IC[k+3] = str(k+1) + ' ' + str(int(SiteID+1)) + ' ' + str(EulerAngles[SiteID,0]) + ' ' + str(EulerAngles[SiteID,1]) + ' ' + str(EulerAngles[SiteID,2]) + '\n'
-                k = k + 1
-            
+    # Text after the site number for each grain ID, formatted once per grain
+    grain_text = np.array([' ' + str(int(SiteID+1)) + ' ' + str(EulerAngles[SiteID,0]) + ' ' + str(EulerAngles[SiteID,1]) + ' ' + str(EulerAngles[SiteID,2]) + '\n' for SiteID in range(len(EulerAngles))])
+    
+    # Write the information in the SPPARKS format (first dimension fastest) a block of planes of the last dimension at a time
+    img_t = img.T #a view, C order of the transpose is the SPPARKS order
+    sites_per_plane = int(np.prod(size[:-1]))
+    planes_per_block = max(1, block_size//sites_per_plane)
+    k = 0
     with open(fp, 'w') as file:
-        file.writelines(IC)
+        file.write('# This line is ignored\n')
+        file.write('Values\n')
+        file.write('\n')
+        for i in range(0, size[-1], planes_per_block):
+            ids = img_t[i:i+planes_per_block].ravel().astype('int64')
+            site_text = np.arange(k+1, k+len(ids)+1).astype(str)
+            file.write(''.join(np.char.add(site_text, grain_text[ids]).tolist()))
+            k += len(ids)
         
     # Completion message
     print("NEW IC WRITTEN TO FILE: %s"%fp)
@@ -405,7 +636,7 @@ def run_spparks(ic, ea, nsteps=500, kt=0.66, cut=25.0, freq=(1,1), rseed=None, m
         ngrain: number of grains
         which_sim ('agg' or 'eng'): dictates which simulator to use where eng is the latest and allows the use of multiple cores 
     Output:
-        path_sim
+        hp_save, fp_save: group and file the simulation was saved to (read "ims_id" with "Trajectory"), None if not "save_sim"
     '''
     
     # Find a simulation path that doesn't already exist (if not told exactly where to run the simulation)
@@ -454,7 +685,7 @@ def run_spparks(ic, ea, nsteps=500, kt=0.66, cut=25.0, freq=(1,1), rseed=None, m
     
     # Write simulation files ('spparks.init', 'spparks.in', 'spparks.sh', 'Miso.txt')
     image2init(ic, ea, r"%s/spparks.init"%path_sim) #write initial condition
-    if np.all(miso_array==None): miso_array = find_misorientation(ea, mem_max=1) 
+    if np.all(miso_array==None): miso_array = find_misorientation_cached(ea, mem_max=1) 
     np.savetxt('%s/Miso.txt'%path_sim, miso_array/np.pi*180/cut) #convert to degrees and divide by cutoff angle
     print('MISO WRITTEN TO FILE: %s/Miso.txt'%path_sim)
     replace_tags(path_edit_in, replacement_text_agg_in, path_sim + "agg.in")
@@ -477,12 +708,8 @@ def run_spparks(ic, ea, nsteps=500, kt=0.66, cut=25.0, freq=(1,1), rseed=None, m
     # Save Simulation
     if save_sim==True:
         
-        # Create miso_matrix
-        miso_matrix = miso_conversion(torch.from_numpy(miso_array[None,]))[0].numpy()
-        
         # Read dump
         fp_save = './data/spparks_sz(%dx%d)_ng(%d)_nsteps(%d)_freq(%d)_kt(%.2f)_cut(%d).h5'%(np.ceil(size[0]),np.ceil(size[1]),ngrain,nsteps,freq[1],kt,cut)
-        ims_id, _, ims_energy = process_dump('%s/spparks.dump'%path_sim)
         tmp = np.array([8,16,32], dtype='uint64')
         dtype = 'uint' + str(tmp[np.sum(ngrain>2**tmp)])
         
@@ -493,66 +720,71 @@ def run_spparks(ic, ea, nsteps=500, kt=0.66, cut=25.0, freq=(1,1), rseed=None, m
             hp_save = 'sim%d'%num_groups
             g = f.create_group(hp_save)
             
-            # Save data
-            dset = g.create_dataset("ims_id", shape=ims_id.shape, dtype=dtype)
-            dset1 = g.create_dataset("ims_energy", shape=ims_energy.shape)
-            dset2 = g.create_dataset("euler_angles", shape=ea.shape)
-            dset3 = g.create_dataset("miso_array", shape=miso_array.shape)
-            dset4 = g.create_dataset("miso_matrix", shape=miso_matrix.shape)
-            dset[:] = ims_id
-            dset1[:] = ims_energy
+            # Save data, the dump is streamed into "ims_id" and "ims_energy" a frame at a time
+            dump2h5('%s/spparks.dump'%path_sim, g, dtype)
+            dset2 = create_h5_dataset(g, "euler_angles", shape=ea.shape, dtype='float32')
             dset2[:] = ea
-            dset3[:] = miso_array #radians (does not save the exact "Miso.txt" file values, which are degrees divided by the cutoff angle)
-            dset4[:] = miso_matrix #same values as mis0_array, different format
             
-        return ims_id, fp_save
+            # Save the misorientations of grains that are neighbors in any frame (radians, same values as miso_array), instead of the dense "miso_array"
+            miso_sparse = SparseMiso(ea, miso_array=miso_array)
+            for t in range(g['ims_id'].shape[0]): miso_sparse.add_image(torch.from_numpy(g['ims_id'][t:t+1].astype('int64'))) #a frame at a time
+            miso_sparse.save(g)
+            
+        return hp_save, fp_save
     
     if del_sim: os.system(r"rm -r %s"%path_sim) #remove entire folder
     
     return None, None
 
 
-def read_dump(path_to_dump='./spparks_simulations/spparks.dump'):
+def iterate_dump(path_to_dump='./spparks_simulations/spparks.dump'):
+    #Reads a SPPARKS dump one frame at a time, yields "item_names" and "item_data" (one array per item, rows by columns) for each frame
+    #A frame ends when an item repeats, the "ATOMS" block is read in one go using the count from "NUMBER OF ATOMS"
     
     with open(path_to_dump) as file: 
         item_names = []
         item_data = []
-        item_index = 0
-        data_lines = []
-        
-        # line = file.readline()
-        # while line!=None:
-        for line in file.readlines(): 
-            if 'ITEM:' in line:
-                
-                # Stack data for previous item
-                if len(data_lines)>0: 
-                    data = np.stack(data_lines)
-                    item_data[item_index].append(data)
-                    if item_index==0: print('Read step: %d'%item_data[0][-1][0,-1])
-                    data_lines = []
-                    
-                # Find item index or add it to the list
-                item = line[6:].replace('\n', '')
-                if item in item_names:
-                    item_index = np.where(np.array(item_names)==item)[0][0]
-                else:
-                    item_names.append(item)
-                    item_data.append([])
-                    item_index = len(item_names) - 1
-    
+        num_atoms = None
+        line = file.readline()
+        while line:
+            item = line[6:].replace('\n', '')
+            
+            # Read the lines of this item
+            if item.startswith('ATOMS') and num_atoms!=None: 
+                lines = list(itertools.islice(file, num_atoms))
+                line = file.readline()
             else:
-                data_line = np.array(line.split()).astype(float)
-                data_lines.append(data_line)
-                
-            # line = file.readline()
-    
-        # Stack data for previous item one last time
-        if len(data_lines)>0: 
-            data = np.stack(data_lines)
-            item_data[item_index].append(data)
-            if item_index==0: print('Read step: %d'%item_data[0][-1][0,-1])
-            data_lines = []
+                lines = []
+                line = file.readline()
+                while line and 'ITEM:' not in line: 
+                    lines.append(line)
+                    line = file.readline()
+            data = np.loadtxt(lines, ndmin=2)
+            if item.startswith('NUMBER OF ATOMS'): num_atoms = int(data[0,0])
+            
+            # Start a new frame when an item repeats
+            if item in item_names: 
+                yield item_names, item_data
+                item_names = []
+                item_data = []
+            item_names.append(item)
+            item_data.append(data)
+        
+        if len(item_names)>0: yield item_names, item_data
+
+
+def read_dump(path_to_dump='./spparks_simulations/spparks.dump'):
+    #Reads every frame of a SPPARKS dump, use "iterate_dump" or "dump2h5" for dumps that don't fit in memory
+    
+    item_names = []
+    item_data = []
+    for names, data in iterate_dump(path_to_dump):
+        for name, d in zip(names, data):
+            if name not in item_names: 
+                item_names.append(name)
+                item_data.append([])
+            item_data[item_names.index(name)].append(d)
+        print('Read step: %d'%item_data[0][-1][0,-1])
     
     # Stack each item into a single tensor 
     for i in range(len(item_data)):
@@ -561,6 +793,38 @@ def read_dump(path_to_dump='./spparks_simulations/spparks.dump'):
     return item_names, item_data
 
 
+def dump_frame_images(item_data):
+    #Arranges the sites of one frame from "iterate_dump" into ID and energy images (1, dim1, dim2) or (1, dim1, dim2, dim3), as in "process_dump"
+    
+    dims = np.flip(np.ceil(item_data[2][:,-1]).astype(int))
+    atoms = item_data[3]
+    if np.any(np.diff(atoms[:,0])<0): atoms = atoms[np.argsort(atoms[:,0], kind='stable')] #sites in order of site number
+    axes = tuple(i for i in range(3) if dims[::-1][i]==1) #singleton dimensions (after transposing)
+    im_id = atoms[:,1].reshape(dims).transpose([2,1,0]).squeeze(axes)[None,]-1
+    im_energy = atoms[:,-1].reshape(dims).transpose([2,1,0]).squeeze(axes)[None,]
+    return im_id, im_energy
+
+
+def dump2h5(path_to_dump, g, dtype='uint32'):
+    #Streams a SPPARKS dump into h5 group "g" one frame at a time, memory stays at about one frame
+    #Writes "ims_id" (frames, 1, dim1, dim2) with "dtype" and "ims_energy", chunked by frame, and "timesteps"
+    
+    dset = dset1 = dset2 = None
+    for i, (item_names, item_data) in enumerate(iterate_dump(path_to_dump)):
+        im_id, im_energy = dump_frame_images(item_data)
+        if dset is None:
+            shape = im_id.shape
+            dset = create_h5_dataset(g, "ims_id", shape=(0,)+shape, dtype=dtype, maxshape=(None,)+shape, sample_dims=1)
+            dset1 = create_h5_dataset(g, "ims_energy", shape=(0,)+shape, dtype='float32', maxshape=(None,)+shape, sample_dims=1)
+            dset2 = create_h5_dataset(g, "timesteps", shape=(0,), dtype='int64', maxshape=(None,))
+        for d in [dset, dset1, dset2]: d.resize(i+1, axis=0)
+        dset[i] = im_id
+        dset1[i] = im_energy
+        dset2[i] = int(item_data[0][0,-1])
+        print('Read step: %d'%dset2[i])
+    return g
+
+
 def process_dump(path_to_dump='./spparks_simulations/spparks.dump'):
     
     # Read dump
@@ -575,80 +839,207 @@ def process_dump(path_to_dump='./spparks_simulations/spparks.dump'):
     # Arrange energy images
     ims_energy = item_data[3][...,-1].reshape((-1,)+tuple(dims)).transpose([0,3,2,1]).squeeze()[:,None,]
     
-    # Find euler angles per ID
+    # Find euler angles per ID (scattered from the sites of the first frame)
     num_grains = int(np.max(item_data[3][0,:,1]))
     euler_angles = np.zeros([num_grains,3])
-    for i in range(np.prod(dims)):
-        ii = int(item_data[3][0,i,1])-1
-        ea = item_data[3][0,i,2:-1]
-        euler_angles[ii] = ea
+    euler_angles[item_data[3][0,:,1].astype(int)-1] = item_data[3][0,:,2:-1]
+    check_euler_angles(euler_angles)
     
     return ims_id, euler_angles, ims_energy
 
 
-def create_SPPARKS_dataset(size=[257,257], ngrains_rng=[256, 256], kt=0.66, cutoff=25.0, nsets=200, max_steps=100, offset_steps=1, future_steps=4, del_sim=False):
-    
-    # DEPRECATED FOR THIS VERSION OF PRIMME, THE USER MUST FIND A SPPARKS TRAINSET MODEL TO USE
-    # SET SIMULATION PATH
-    path_sim = './spparks_simulation_trainset/'
-        
-    # NAMING CONVENTION   
-    fp = './data/trainset_spparks_sz(%dx%d)_ng(%d-%d)_nsets(%d)_future(%d)_max(%d)_kt(%.2f)_cut(%d).h5'%(size[0],size[1],ngrains_rng[0],ngrains_rng[1],nsets,future_steps,max_steps,kt,cutoff)
+class Simulator:
+    #Interface of the simulators used by "create_trainset" to grow each set
+    #"run(ic, ea, miso_array, nsteps, path_sim, seed)" returns "ims_id" and "ims_energy", each (nsteps+1, 1, dim1, dim2), the first frame is "ic"
+    #"path_sim" is a folder only this run uses (for simulators that work through files), "seed" makes the run reproducible
+    #Objects are sent to worker processes, so they must be picklable (no open files or devices)
+    
+    def run(self, ic, ea, miso_array, nsteps, path_sim, seed):
+        raise NotImplementedError('Simulator.run must be implemented by: %s'%type(self).__name__)
+
+
+class StandInSimulator(Simulator):
+    #Cheap deterministic stand-in to check "create_trainset" without SPPARKS (e.g. "test_trainset.py")
+    #Each step a fraction "frac" of the pixels take the id of a random neighbor (periodic), chosen with "seed"
+    
+    def __init__(self, frac=0.1):
+        self.frac = frac
+    
+    def run(self, ic, ea, miso_array, nsteps, path_sim, seed):
+        rng = np.random.default_rng(seed)
+        im = np.asarray(ic)
+        shifts = [(s, d) for d in range(im.ndim) for s in [-1, 1]]
+        ims_id, ims_energy = [], []
+        for t in range(nsteps+1):
+            nbs = np.stack([np.roll(im, s, d) for s, d in shifts])
+            if t>0: 
+                nb = np.take_along_axis(nbs, rng.integers(len(shifts), size=(1,)+im.shape), 0)[0]
+                im = np.where(rng.random(im.shape)<self.frac, nb, im)
+                nbs = np.stack([np.roll(im, s, d) for s, d in shifts])
+            ims_id.append(im)
+            ims_energy.append((nbs!=im).sum(0)) #number of different neighbors
+        return np.stack(ims_id)[:,None], np.stack(ims_energy)[:,None]
+
+
+class SPPARKSSimulator(Simulator):
+    #Grows each set with SPPARKS through "run_spparks" (needs the SPPARKS build and "./spparks_files/")
+    
+    def __init__(self, kt=0.66, cutoff=25.0, which_sim='agg', freq=(1,1)):
+        self.kt = kt
+        self.cutoff = cutoff
+        self.which_sim = which_sim
+        self.freq = freq
+    
+    def run(self, ic, ea, miso_array, nsteps, path_sim, seed):
+        rseed = int(np.random.default_rng(seed).integers(10000)) #SPPARKS seed
+        cwd = os.getcwd()
+        try: run_spparks(ic, ea, nsteps, self.kt, self.cutoff, self.freq, rseed, miso_array=miso_array, which_sim=self.which_sim, save_sim=False, del_sim=False, path_sim=path_sim)
+        finally: os.chdir(cwd) #"run_spparks" returns to "../" from "path_sim"
+        ims_id, _, ims_energy = process_dump('%s/spparks.dump'%path_sim)
+        return ims_id, ims_energy
+
 
+def open_trainset(f, params):
+    #Creates the datasets of a trainset in h5 file "f", or returns the existing ones to resume if "params" match those it was created with
+    #"params" - dictionary with at least 'size', 'ngrains_rng', 'nsets' and 'future_steps', saved as a json attribute
+    #Returns "ims_id" (nsets, future_steps+1, 1, dim1, dim2), "ims_energy", "euler_angles" and "done" (sets written)
+    #Misorientations are not saved, they follow from "euler_angles" (see "read_trainset_miso")
+    
+    if 'done' in f.keys() and 'params' in f.attrs: #resume
+        if json.loads(f.attrs['params'])!=params: raise Exception('Trainset exists with different parameters: %s'%f.filename)
+        return f['ims_id'], f['ims_energy'], f['euler_angles'], f['done']
+    
     # DETERMINE THE SMALLEST POSSIBLE DATA TYPE POSSIBLE
-    m = np.max(ngrains_rng)
+    nsets = params['nsets']
+    m = np.max(params['ngrains_rng'])
     tmp = np.array([8,16,32], dtype='uint64')
     dtype = 'uint' + str(tmp[np.sum(m>2**tmp)])
     
-    h5_shape = (nsets, future_steps+1, 1) + tuple(size)
+    h5_shape = (nsets, params['future_steps']+1, 1) + tuple(params['size'])
     h5_shape2 = (nsets, m, 3)
-    h5_shape3 = (nsets, int(m*(m-1)/2))
+    dset = create_h5_dataset(f, "ims_id", shape=h5_shape, dtype=dtype, sample_dims=1) #one set per chunk
+    dset1 = create_h5_dataset(f, "ims_energy", shape=h5_shape, dtype='float32', sample_dims=1)
+    dset2 = create_h5_dataset(f, "euler_angles", shape=h5_shape2, dtype='float32', sample_dims=1)
+    done = create_h5_dataset(f, "done", shape=(nsets,), dtype=bool)
+    f.attrs['params'] = json.dumps(params)
+    return dset, dset1, dset2, done
+
+
+def read_trainset_miso(f, sets=slice(None)):
+    #Returns the misorientations ("miso_array" rows, radians) of sets "sets" (slice or increasing indices) of trainset h5 file "f"
+    #Read from "miso_array" in trainsets that saved it, otherwise found from "euler_angles" with "find_misorientation_cached" (computed once per set)
+    if 'miso_array' in f.keys(): return f['miso_array'][sets]
+    return np.stack([find_misorientation_cached(ea, mem_max=1) for ea in f['euler_angles'][sets]])
+
+
+def trainset_mode(fp, params):
+    #Mode to open trainset file "fp" with for "open_trainset": 'a' to create or resume it, 'w' to start over if it has no resume information (e.g. written by an older "create_SPPARKS_dataset")
+    if not os.path.exists(fp): return 'a'
+    with h5py.File(fp, 'r') as f:
+        if 'done' in f.keys() and 'params' in f.attrs: return 'a'
+    print("TRAINSET HAS NO RESUME INFORMATION, STARTING OVER: %s"%fp)
+    return 'w'
+
+
+def trainset_set_params(seed, ngrains_rng, max_steps, offset_steps, future_steps):
+    #Random number of grains, number of steps, initial condition seed and simulation seed of one set from its sub-seed "seed"
+    rng = np.random.default_rng(seed)
+    ngrains = int(rng.integers(ngrains_rng[0], ngrains_rng[1]+1)) #number of grains
+    nsteps = int(rng.integers(offset_steps+future_steps, max_steps+1)) #steps to run
+    return ngrains, nsteps, int(rng.integers(2**31)), int(rng.integers(2**31))
+
+
+def trainset_frozen(ims_id):
+    #True if the frames kept from a set (the offset frame and the future frames) are all the same, such a set teaches nothing about growth
+    return bool(np.all(ims_id==ims_id[:1]))
+
+
+def trainset_redraw(seed, attempt, nsteps, offset_steps, future_steps, max_attempts=20):
+    #Sub-seed and "max_steps" to grow a frozen set again, from a new initial condition and with fewer steps than the "nsteps" it had stopped by
+    if attempt>max_attempts: raise Exception('Sets are still frozen after %d attempts, use fewer steps or a simulator that keeps growing (e.g. a larger mode filter "window_size")'%max_attempts)
+    return int(np.random.SeedSequence([seed, attempt]).generate_state(1)[0]), max(offset_steps+future_steps, nsteps-1)
+
+
+def _create_trainset_worker(inputs):
+    #Generates and grows one set (runs in a worker process of "create_trainset")
+    i, simulator, size, ngrains_rng, max_steps, offset_steps, future_steps, seed, path_sim, del_sim = inputs
+    torch.set_num_threads(1) #one thread per worker, the pool provides the parallelism
+    set_seed, attempt = seed, 0
+    while True:
+        ngrains, nsteps, seed_ic, seed_sim = trainset_set_params(set_seed, ngrains_rng, max_steps, offset_steps, future_steps)
+        ic, ea = generate_ic('grain', [size, ngrains], 'cpu', seed=seed_ic)
+        miso_array = find_misorientation(ea, mem_max=1, device='cpu')
+        ims_id, ims_energy = simulator.run(ic, ea, miso_array, nsteps, path_sim, seed_sim)
+        if del_sim and os.path.exists(path_sim): shutil.rmtree(path_sim)
+        if not trainset_frozen(ims_id[-(future_steps+1):]): break
+        attempt += 1
+        set_seed, max_steps = trainset_redraw(seed, attempt, nsteps, offset_steps, future_steps)
+    return i, ims_id[-(future_steps+1):], ims_energy[-(future_steps+1):], ea
+
+
+def create_trainset(simulator, fp, size=[257,257], ngrains_rng=[256, 256], nsets=200, max_steps=100, offset_steps=1, future_steps=4, seed=0, num_workers=None, path_sim='./trainset_simulation', del_sim=True):
+    #Grows "nsets" random Voronoi initial conditions with "simulator" (see "Simulator") in a pool of "num_workers" processes and writes the last "future_steps"+1 frames of each to "fp"
+    #Each set "i" runs in its own folder "path_sim_i/" (next to "path_sim", as "run_spparks" expects) with its own sub-seed from "seed", so sets are reproducible regardless of "num_workers"
+    #The main process is the only writer, sets are marked in "done" as they are written, so an interrupted call picks up where it stopped
+    #Sets that stopped changing ("trainset_frozen") are grown again from a new initial condition with fewer steps ("trainset_redraw")
+    
+    if num_workers==None: num_workers = os.cpu_count()
+    params = {'simulator': type(simulator).__name__, 'seed': seed, 'size': list(size), 'ngrains_rng': list(ngrains_rng), 'nsets': nsets, 'max_steps': max_steps, 'offset_steps': offset_steps, 'future_steps': future_steps}
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(nsets)]
+    
+    with h5py.File(fp, trainset_mode(fp, params)) as f:
+        dset, dset1, dset2, done = open_trainset(f, params)
+        todo = np.nonzero(~done[:])[0]
+        inputs = [(i, simulator, size, ngrains_rng, max_steps, offset_steps, future_steps, seeds[i], '%s_%d/'%(path_sim.rstrip('/'), i), del_sim) for i in todo]
+        with multiprocessing.Pool(min(num_workers, max(len(todo), 1))) as pool: 
+            for i, ims_id, ims_energy, ea in tqdm(pool.imap_unordered(_create_trainset_worker, inputs), 'Growing sets', total=len(inputs)):
+                dset[i,] = ims_id
+                dset1[i,] = ims_energy
+                dset2[i,:len(ea),] = ea
+                done[i] = True
+                f.flush()
+    
+    print("TRAINSET WRITTEN TO FILE: %s"%fp)
+    return fp
 
-    with h5py.File(fp, 'w') as f:
-        dset = f.create_dataset("ims_id", shape=h5_shape, dtype=dtype)
-        dset1 = f.create_dataset("ims_energy", shape=h5_shape)
-        dset2 = f.create_dataset("euler_angles", shape=h5_shape2)
-        dset3 = f.create_dataset("miso_array", shape=h5_shape3)
-        for i in tqdm(range(nsets)):
-            
-            # SET PARAMETERS
-            ngrains = np.random.randint(ngrains_rng[0], ngrains_rng[1]+1) #number of grains
-            nsteps = np.random.randint(offset_steps+future_steps, max_steps+1) #SPPARKS steps to run
-            freq = (1,1) #how often to report stats on the simulation, how often to dump an image (record)
-            rseed = np.random.randint(10000) #change to get different growth from teh same initial condition
-            
-            # RUN SIMULATION
-            im, ea, _ = voronoi2image(size, ngrains) #generate initial condition
-            miso_array = find_misorientation(ea, mem_max=1) 
-            run_spparks(im, ea, nsteps, kt, cutoff, freq, rseed, miso_array=miso_array, save_sim=False, del_sim=False, path_sim=path_sim)
-            grain_ID_images, grain_euler_angles, ims_energy = process_dump('%s/spparks.dump'%path_sim)
-            # miso = np.loadtxt('%s/Miso.txt'%path_sim)*cutoff/180*np.pi #convert to radians
-            
-            # WRITE TO FILE
-            dset[i,] = grain_ID_images[-(future_steps+1):,] 
-            dset1[i,] = ims_energy[-(future_steps+1):,] 
-            dset2[i,:ngrains,] = grain_euler_angles
-            dset3[i:int(ngrains*(ngrains-1)/2),] = miso_array
-            
-    if del_sim: os.system(r"rm -r %s"%path_sim) #remove entire folder
+
+def create_SPPARKS_dataset(size=[257,257], ngrains_rng=[256, 256], kt=0.66, cutoff=25.0, nsets=200, max_steps=100, offset_steps=1, future_steps=4, del_sim=True, seed=0, num_workers=None, simulator=None):
     
-    return fp
+    # DEPRECATED FOR THIS VERSION OF PRIMME, THE USER MUST FIND A SPPARKS TRAINSET MODEL TO USE
+    # Sets are grown in parallel by "create_trainset", "simulator" replaces SPPARKS (e.g. a stand-in for testing)
+    # Each set runs in its own SPPARKS folder, "del_sim" removes it once the set is grown (keep them only to inspect a few sets)
+    
+    # NAMING CONVENTION   
+    fp = './data/trainset_spparks_sz(%dx%d)_ng(%d-%d)_nsets(%d)_future(%d)_max(%d)_kt(%.2f)_cut(%d).h5'%(size[0],size[1],ngrains_rng[0],ngrains_rng[1],nsets,future_steps,max_steps,kt,cutoff)
+    
+    if simulator==None: simulator = SPPARKSSimulator(kt, cutoff)
+    path_sim = './spparks_simulation_trainset'
+    return create_trainset(simulator, fp, size, ngrains_rng, nsets, max_steps, offset_steps, future_steps, seed, num_workers, path_sim, del_sim)
+
+
+def check_euler_angles(euler_angles):
+    #Warns about grains whose euler angles were never found (left at zero), e.g. IDs without any sites
+    missing = np.all(euler_angles.reshape(-1,3)==0, axis=1)
+    if np.sum(euler_angles==0)>0: 
+        print("Some euler angles are zero in value. Something might have gone wrong.")
+        if np.any(missing): print("No euler angles for %d grain IDs, first: %d"%(np.sum(missing), np.argmax(missing)+1))
 
 
-def init2euler(f_init='Case4.init', num_grains=20000):
+def init2euler(f_init='Case4.init', num_grains=20000, block_size=2**20):
     # Extracts euler angles for each grain ID from a SPPARKS ".init" file
     # "f_init" - string of the location of the ".init" file
-    
-    with open(f_init) as file: 
-        f_lines = file.readlines()[3:]
+    # "block_size" - number of lines parsed at a time
     
     ea = np.zeros([1, num_grains, 3])
-    for l in f_lines: 
-        tmp = np.array(l.replace('\n', '').split(' ')).astype(float)
-        ea[:,int(tmp[1]-1),:] = tmp[2:]
+    with open(f_init) as file: 
+        for i in range(3): file.readline() #header
+        while True:
+            lines = list(itertools.islice(file, block_size))
+            if len(lines)==0: break
+            tmp = np.loadtxt(lines, ndmin=2)
+            ea[0,(tmp[:,1]-1).astype(int),:] = tmp[:,2:]
     
-    if np.sum(ea==0)>0: 
-        print("Some euler angles are zero in value. Something might have gone wrong.")
+    check_euler_angles(ea)
     
     return ea
 
@@ -656,7 +1047,7 @@ def init2euler(f_init='Case4.init', num_grains=20000):
 def append_h5(fp, hp, var_names, var_list):
     with h5py.File(fp, 'a') as f:
         for i in range(len(var_names)):
-            f[hp + '/' + var_names[i]] = var_list[i]
+            create_h5_dataset(f, hp + '/' + var_names[i], data=var_list[i])
             
 
 def extract_spparks_logfile_energy(logfile_path="32c20000grs2400stskT050_cut25.logfile"):
@@ -683,6 +1074,227 @@ def extract_spparks_logfile_energy(logfile_path="32c20000grs2400stskT050_cut25.l
             
     return energy
 
+### Monte Carlo Potts
+def sublattices(size, device=device):
+    #Splits a periodic lattice with 8 (2D) or 26 (3D) neighbors into sets of sites that are not neighbors of each other
+    #Each dimension alternates two colors, an odd dimension gives its last index a third color so the wrap around never touches
+    #Returns a list of flat site indices (long), one per sublattice
+    colors = []
+    for n in size:
+        c = torch.arange(n, device=device)%2
+        if n%2==1: c[-1] = 2
+        colors.append(c)
+    grid = torch.stack(torch.meshgrid(*colors, indexing='ij')).reshape(len(size), -1)
+    key = sum(grid[d]*3**d for d in range(len(size)))
+    return [torch.nonzero(key==k)[:,0] for k in torch.unique(key)]
+
+
+def neighbor_sites(sites, size):
+    #Flat indices (num sites, 3**dims-1) of the periodic neighbors of flat site indices "sites" in a lattice of "size"
+    size_t = torch.tensor(size, device=sites.device)
+    coords = torch.stack(torch.unravel_index(sites, tuple(size)), dim=1) #(num sites, dims)
+    offsets = torch.cartesian_prod(*[torch.tensor([-1,0,1], device=sites.device)]*len(size)).reshape(-1, len(size))
+    offsets = offsets[torch.any(offsets!=0, dim=1)]
+    nc = (coords[:,None,:]+offsets[None,])%size_t
+    strides = torch.tensor([int(np.prod(size[d+1:])) for d in range(len(size))], device=sites.device)
+    return torch.sum(nc*strides, dim=2)
+
+
+def read_shockley(miso_matrix, cutoff=25.0):
+    #Grain boundary energy of each misorientation (radians), Read-Shockley up to "cutoff" (degrees) and 1 above, as in SPPARKS
+    theta = torch.clamp(miso_matrix/(cutoff/180*np.pi), max=1)
+    return torch.where(theta>0, theta*(1-torch.log(torch.clamp(theta, min=1e-12))), torch.zeros_like(theta))
+
+
+def site_energy(imf, nbrs, gamma=None):
+    #Energy of flat image "imf" at each site with neighbors "nbrs" (from "neighbor_sites"), 
+    #the number of different neighbors, or the sum of boundary energies "gamma" (num grains, num grains) if given
+    nv = imf[nbrs]
+    if gamma is None: return torch.sum(nv!=imf[:,None], dim=1).float()
+    return torch.sum(gamma[imf[:,None], nv], dim=1)
+
+
+def run_potts(ic, nsteps=100, kt=0.66, miso_matrix=None, cutoff=25.0, seed=None, device=device):
+    #Monte Carlo Potts grain growth of "ic" (dim1, dim2) or (dim1, dim2, dim3) with periodic boundaries for "nsteps" Monte Carlo steps
+    #Each step visits every site once, sublattice by sublattice (in random order) so all sites of a sublattice flip at once
+    #A site proposes the ID of a random neighbor and accepts if the energy change dE<=0, or with probability exp(-dE/kt), as SPPARKS "agg"
+    #Energy is the number of different neighbors, or Read-Shockley boundary energies (see "read_shockley") of "miso_matrix" if given
+    #Returns "ims_id" and "ims_energy" (site energies), shape=(nsteps+1, 1, dim1, dim2)
+    
+    size = tuple(ic.shape)
+    gen = torch.Generator(device=device)
+    if seed!=None: gen.manual_seed(seed)
+    else: gen.seed()
+    imf = torch.as_tensor(np.asarray(ic)).to(device).long().flatten()
+    gamma = None if miso_matrix is None else read_shockley(torch.as_tensor(miso_matrix).to(device).float(), cutoff)
+    
+    # Sites and neighbors of each sublattice
+    subs = sublattices(size, device)
+    nbrs_sub = [neighbor_sites(s, size) for s in subs]
+    nbrs_all = neighbor_sites(torch.arange(imf.shape[0], device=device), size)
+    
+    ims_id = [imf.cpu().numpy().reshape(size).copy()] #a copy, "imf" is updated in place
+    ims_energy = [site_energy(imf, nbrs_all, gamma).cpu().numpy().reshape(size)]
+    for t in tqdm(range(nsteps), 'Running Potts'):
+        for k in torch.randperm(len(subs), generator=gen, device=device).tolist():
+            sites, nbrs = subs[k], nbrs_sub[k]
+            nv = imf[nbrs] #neighbor IDs (num sites, num neighbors)
+            a = imf[sites]
+            r = torch.randint(nv.shape[1], (len(sites),), generator=gen, device=device)
+            b = nv[torch.arange(len(sites), device=device), r] #proposed IDs
+            if gamma is None: dE = torch.sum(nv!=b[:,None], dim=1) - torch.sum(nv!=a[:,None], dim=1)
+            else: dE = torch.sum(gamma[b[:,None], nv], dim=1) - torch.sum(gamma[a[:,None], nv], dim=1)
+            accept = dE<=0
+            if kt>0: accept = accept | (torch.rand(len(sites), generator=gen, device=device)<torch.exp(-dE/kt))
+            imf[sites[accept]] = b[accept]
+        ims_id.append(imf.cpu().numpy().reshape(size).copy())
+        ims_energy.append(site_energy(imf, nbrs_all, gamma).cpu().numpy().reshape(size))
+    
+    return np.stack(ims_id)[:,None], np.stack(ims_energy)[:,None]
+
+
+class PottsSimulator(Simulator):
+    #Grows each set with "run_potts" (no SPPARKS needed), "if_miso" weights boundaries by the misorientations of the set
+    
+    def __init__(self, kt=0.66, cutoff=25.0, if_miso=False, device='cpu'):
+        self.kt = kt
+        self.cutoff = cutoff
+        self.if_miso = if_miso
+        self.device = device
+    
+    def run(self, ic, ea, miso_array, nsteps, path_sim, seed):
+        miso_matrix = None
+        if self.if_miso: miso_matrix = miso_conversion(torch.as_tensor(miso_array)[None,])[0]
+        return run_potts(ic, nsteps, self.kt, miso_matrix, self.cutoff, seed, self.device)
+
+
+def create_potts_dataset(size=[257,257], ngrains_rng=[256, 256], kt=0.66, cutoff=25.0, nsets=200, max_steps=100, offset_steps=1, future_steps=4, if_miso=False, seed=0, num_workers=None):
+    #Trainset for "train_primme" grown with "PottsSimulator", in the same layout as "create_SPPARKS_dataset"
+    
+    # NAMING CONVENTION   
+    fp = './data/trainset_potts_sz(%dx%d)_ng(%d-%d)_nsets(%d)_future(%d)_max(%d)_kt(%.2f)_cut(%d)_miso(%d).h5'%(size[0],size[1],ngrains_rng[0],ngrains_rng[1],nsets,future_steps,max_steps,kt,cutoff,if_miso)
+    
+    simulator = PottsSimulator(kt, cutoff, if_miso)
+    return create_trainset(simulator, fp, size, ngrains_rng, nsets, max_steps, offset_steps, future_steps, seed, num_workers)
+
+
+### Mode filter
+def mode_filter(ims, window_size=3, pad_mode='circular', generator=None):
+    #One step of mode filter grain growth for a batch "ims" (num images, 1, dim1, dim2) or (num images, 1, dim1, dim2, dim3)
+    #Each pixel takes the most common ID in its window (3x3 or 3x3x3 for "window_size"=3), ties are broken at random
+    #Counts are found one window position at a time, so memory is the unfolded windows plus two images
+    #3x3 windows stop once boundaries are flat (about 20 steps for 256 grains in 257x257), 7x7 windows keep coarsening past 100 steps
+    
+    ims_unfold = my_unfoldNd(ims.float(), kernel_size=window_size, pad_mode=pad_mode) #shape = [N, product(kernel_size), dim1*dim2*dim3]
+    mode = ims_unfold[:,0].clone()
+    mode_count = torch.full(mode.shape, -1.0, device=ims.device)
+    for k in range(ims_unfold.shape[1]):
+        count = torch.sum(ims_unfold==ims_unfold[:,k:k+1], dim=1) + torch.rand(mode.shape, generator=generator, device=ims.device) #random fraction breaks ties
+        ii = count>mode_count
+        mode[ii] = ims_unfold[:,k][ii]
+        mode_count[ii] = count[ii]
+    return mode.reshape(ims.shape).to(ims.dtype)
+
+
+def run_mode_filter(ics, nsteps=100, window_size=7, pad_mode='circular', seed=None, device=device):
+    #Mode filter grain growth of a batch of initial conditions "ics" (num images, dim1, dim2) or (num images, dim1, dim2, dim3) for "nsteps" steps
+    #Returns "ims_id" and "ims_energy" (number of different neighbors), shape=(num images, nsteps+1, 1, dim1, dim2)
+    
+    gen = torch.Generator(device=device)
+    if seed!=None: gen.manual_seed(seed)
+    else: gen.seed()
+    ims = torch.as_tensor(np.asarray(ics)).to(device).long()[:,None]
+    ims_id = [ims.cpu().numpy()]
+    ims_energy = [num_diff_neighbors(ims.float(), window_size, pad_mode).cpu().numpy()]
+    for t in tqdm(range(nsteps), 'Running mode filter'):
+        ims = mode_filter(ims, window_size, pad_mode, gen)
+        ims_id.append(ims.cpu().numpy())
+        ims_energy.append(num_diff_neighbors(ims.float(), window_size, pad_mode).cpu().numpy())
+    return np.stack(ims_id, axis=1), np.stack(ims_energy, axis=1)
+
+
+class ModeFilterSimulator(Simulator):
+    #Grows each set with "run_mode_filter", for "create_trainset" (use "create_mode_filter_dataset" to grow many sets at once on one device)
+    
+    def __init__(self, window_size=7, pad_mode='circular', device='cpu'):
+        self.window_size = window_size
+        self.pad_mode = pad_mode
+        self.device = device
+    
+    def run(self, ic, ea, miso_array, nsteps, path_sim, seed):
+        ims_id, ims_energy = run_mode_filter(np.asarray(ic)[None,], nsteps, self.window_size, self.pad_mode, seed, self.device)
+        return ims_id[0], ims_energy[0]
+
+
+def create_mode_filter_dataset(size=[257,257], ngrains_rng=[256, 256], nsets=200, max_steps=100, offset_steps=1, future_steps=4, window_size=7, pad_mode='circular', batch_size=50, seed=0, device=device):
+    #Trainset for "train_primme" grown with "mode_filter", in the same layout as "create_SPPARKS_dataset"
+    #"batch_size" sets are grown at once, each set is kept only for its last "future_steps"+1 frames, so memory doesn't grow with "max_steps"
+    #Sets have the same initial conditions and number of steps as "create_trainset" with the same "seed", batches that were written are skipped when resumed
+    #Frozen sets (no change over the frames kept) are not written, they are grown again with the next batch pass as in "create_trainset"
+    
+    # NAMING CONVENTION   
+    fp = './data/trainset_modefilter_sz(%dx%d)_ng(%d-%d)_nsets(%d)_future(%d)_max(%d)_win(%d).h5'%(size[0],size[1],ngrains_rng[0],ngrains_rng[1],nsets,future_steps,max_steps,window_size)
+    
+    params = {'simulator': 'mode_filter', 'seed': seed, 'size': list(size), 'ngrains_rng': list(ngrains_rng), 'nsets': nsets, 'max_steps': max_steps, 'offset_steps': offset_steps, 'future_steps': future_steps, 'window_size': window_size, 'batch_size': batch_size}
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(nsets)]
+    
+    with h5py.File(fp, trainset_mode(fp, params)) as f:
+        dset, dset1, dset2, done = open_trainset(f, params)
+        
+        for i in tqdm(range(0, nsets, batch_size), 'Growing batches'):
+            j = min(i+batch_size, nsets)
+            if np.all(done[i:j]): continue
+            
+            todo = list(range(i, j))
+            set_seeds = {k: seeds[k] for k in todo}
+            set_steps = {k: max_steps for k in todo}
+            attempt = 0
+            while len(todo)>0:
+                
+                # Initial conditions
+                set_params = [trainset_set_params(set_seeds[k], ngrains_rng, set_steps[k], offset_steps, future_steps) for k in todo]
+                ics, eas = [], []
+                for ngrains, nsteps, seed_ic, _ in set_params:
+                    ic, ea = generate_ic('grain', [size, ngrains], device, seed=seed_ic)
+                    ics.append(ic)
+                    eas.append(ea)
+                
+                # Grow the batch, keep the last frames of each set as they pass
+                gen = torch.Generator(device=device)
+                gen.manual_seed(set_params[0][3])
+                ends = np.array([p[1] for p in set_params]) #last step of each set
+                ims = torch.as_tensor(np.stack(ics)).to(device).long()[:,None]
+                ims_id = np.zeros((len(todo),)+dset.shape[1:], dtype=dset.dtype)
+                ims_energy = np.zeros((len(todo),)+dset1.shape[1:], dtype=dset1.dtype)
+                for t in range(ends.max()+1):
+                    if t>0: ims = mode_filter(ims, window_size, pad_mode, gen)
+                    kk = np.nonzero((t>=ends-future_steps) & (t<=ends))[0]
+                    if len(kk)>0:
+                        energy = num_diff_neighbors(ims[kk].float(), window_size, pad_mode)
+                        for n, k in enumerate(kk):
+                            ims_id[k, t-ends[k]+future_steps] = ims[k].cpu().numpy()
+                            ims_energy[k, t-ends[k]+future_steps] = energy[n].cpu().numpy()
+                
+                # Write the sets that still changed, grow the frozen ones again from new initial conditions with fewer steps
+                frozen = []
+                attempt += 1
+                for n, k in enumerate(todo):
+                    if trainset_frozen(ims_id[n]): 
+                        frozen.append(k)
+                        set_seeds[k], set_steps[k] = trainset_redraw(seeds[k], attempt, set_params[n][1], offset_steps, future_steps)
+                        continue
+                    dset[k] = ims_id[n]
+                    dset1[k] = ims_energy[n]
+                    dset2[k,:len(eas[n]),] = eas[n]
+                if len(frozen)>0: print('GROWING %d FROZEN SETS AGAIN'%len(frozen))
+                todo = frozen
+            done[i:j] = True
+            f.flush()
+    
+    print("TRAINSET WRITTEN TO FILE: %s"%fp)
+    return fp
+
+
 ### Find misorientations
 #Code from Lin, optimized by Joseph Melville
 
@@ -811,77 +1423,200 @@ def quat_Multi(q1, q2):
     return torch.stack(tmp).transpose(2,0)
 
 
+def miso_line_to_pairs(k):
+    #Inverse of "get_line", returns the grain pair (i<j) found on each row "k" of MisoEnergy.txt
+    #'k' - torch, long, rows are ordered by "j" first and "i" second, i.e. k = i+(j-1)*j/2
+    
+    j = torch.floor((1+torch.sqrt(1+8*k.double()))/2).long()
+    j[j*(j-1)//2>k] -= 1 #correct floating point rounding 
+    j[(j+1)*j//2<=k] += 1
+    i = k - j*(j-1)//2
+    return i, j
+
+
+def symetric_quaternions_conj(device=device):
+    # Conjugates of the cubic symmetry quaternions, used by "misorientation_kernel"
+    sym_conj = torch.from_numpy(symetric_quaternions()).to(device)
+    sym_conj[:,1:] = -sym_conj[:,1:]
+    return sym_conj
+
+
+def misorientation_kernel(qi, qj, sym_conj):
+    # Returns the misorientation angle (radians) between each pair of quaternions in 'qi' and 'qj' (torch, shape=(number of pairs, 4))
+    # The scalar part of Si*qi*conj(Sj*qj) equals that of qi*conj(qj)*conj(Sj)*Si, and conj(Sj)*Si covers the 24 operators
+    # So only the 24 operators applied to one side of the relative rotation are needed, instead of all 24*24 combinations
+    
+    # Find the rotation between each pair of grain orientations
+    qj = qj.clone()
+    qj[:,1:] = -qj[:,1:]
+    qq = quat_Multi(qi.unsqueeze(1), qj.unsqueeze(1))[0]
+    
+    # The scalar part of the rotation combined with each symmetry operator is a dot product with the conjugate operator
+    # The minimum angle comes from the largest absolute scalar part (the absolute value maps angles above pi back below pi)
+    w = torch.max(torch.abs(qq @ sym_conj.T), dim=1)[0]
+    return 2*torch.acos(torch.clamp(w, max=1))
+
+
 def find_misorientation(angles, mem_max=1, if_quat=False, device=device):
     # 'angles' - numpy, shape=(number of grains, 3), euler (yaw, pitch, roll) is default, quaternion is "if_quat==True"
     # 'mem_max' - total memory that can be used by the function in GB
     
     angles = torch.from_numpy(angles).to(device)
     num_grains = angles.shape[0]
+    num_lines = int(num_grains*(num_grains-1)/2)
     
-    # Create and expand symmetry quaternions   (assumes cubic symmetry)
-    sym = torch.from_numpy(symetric_quaternions()).to(device)
-    tmp = torch.arange(24)
-    i0, j0 = list(torch.cartesian_prod(tmp,tmp).T) #pair indicies for expanding the symmetry orientations
-    symi = sym[i0,:].unsqueeze(0) 
-    symj = sym[j0,:].unsqueeze(0)
+    # Create symmetry quaternions (assumes cubic symmetry)
+    sym_conj = symetric_quaternions_conj(device)
     
-    # Convert grain euler angles to quaternions, then expand in chunks for processing
+    # Convert grain euler angles to quaternions
     if if_quat: q = angles #if quaternions given
     else: q = euler2quaternion(angles) #if euler angles given
-    tmp = torch.arange(num_grains)
-    i1, j1 = list(torch.cartesian_prod(tmp,tmp).T) #pair indicies for expanding the grain orientations
-    
-    # Rearrange indicies to match SPPARKS 'Miso.txt' format
-    i_tmp = i1[i1<j1]
-    j_tmp = j1[i1<j1]
-    i1 = i_tmp
-    j1 = j_tmp
-
-    ii = torch.from_numpy(get_line(i1.numpy(),j1.numpy())).long()#.to(device)
-
-    i_tmp = i1.clone()
-    i_tmp[ii] = i1
-    i1 = i_tmp
-
-    j_tmp = j1.clone()
-    j_tmp[ii] = j1
-    j1 = j_tmp
+    q = q.to(sym_conj.dtype)
     
-    # Break quaternion expansion into chunks limited by memory
-    mem_per_indx = 24**2*4*64/1e9 #GB per index
-    size_chunks = int(mem_max/mem_per_indx)
-    num_chunks = int(np.ceil(len(i1)/size_chunks))
-    tmp = torch.arange(len(i1))
-    i_chunks = torch.chunk(tmp, num_chunks, dim=0)
+    # Break the rows of 'Miso.txt' into chunks limited by memory (the grain pairs are generated per chunk)
+    mem_per_indx = 24*4*64/1e9 #GB per index
+    size_chunks = max(int(mem_max/mem_per_indx), 1)
+    num_chunks = int(np.ceil(num_lines/size_chunks))
     
     # Find angle/axis values for each misorientation
     angles = []
     # axis = []
-    for ii in tqdm(i_chunks, "Finding misorientations"): 
+    for c in tqdm(range(num_chunks), "Finding misorientations"): 
         
-        # Find the chunked indices for expansion
-        i2 = i1[ii] 
-        j2 = j1[ii]
-        qi = q[i2,:].unsqueeze(1)
-        qj = q[j2,:].unsqueeze(1)
-        
-        # Multiply all pairs of symmetry orientations with all pairs of grain orientations (in this chunk)
-        q1 = quat_Multi(symi, qi)
-        q2 = quat_Multi(symj, qj)
-        
-        # Find the rotations between all pairs of orientations
-        q2[...,1:] = -q2[...,1:]
-        qq = quat_Multi(q1, q2).transpose(0,1)
-        
-        # Find the roation that gives the minimum angle
-        angle0 = 2*torch.acos(qq[...,0])
-        angle0[angle0>np.pi] = torch.abs(angle0[angle0>np.pi] - 2*np.pi)
-        angle_tmp = torch.min(angle0, axis=0)[0]
+        # Find the grain pairs of the rows in this chunk, in SPPARKS 'Miso.txt' order
+        k = torch.arange(c*size_chunks, min((c+1)*size_chunks, num_lines), device=device)
+        i2, j2 = miso_line_to_pairs(k)
+        angle_tmp = misorientation_kernel(q[i2,:], q[j2,:], sym_conj)
         angles.append(angle_tmp.cpu().numpy())
-
+    
+    if len(angles)==0: return np.zeros(0)
     return np.hstack(angles) #misorientation is the angle, radians
 
 
+### Misorientation cache
+#Misorientations are stored in "cache_dir" under a hash of the euler angles and symmetry, as memory mapped ".npy" files
+#The most recently used arrays are also kept in memory, least recently used entries are evicted first from both
+
+miso_memory_cache = OrderedDict()
+
+
+def miso_cache_key(angles, if_quat=False, Osym=24):
+    #Returns a hash of the orientations and symmetry that define a misorientation array
+    angles = np.ascontiguousarray(angles)
+    h = hashlib.sha1(angles.tobytes())
+    h.update(json.dumps({"dtype": str(angles.dtype), "shape": angles.shape, "if_quat": if_quat, "Osym": Osym}).encode())
+    return h.hexdigest()
+
+
+def find_misorientation_cached(angles, mem_max=1, if_quat=False, device=device, cache_dir='./data/miso_cache/', max_gb=10, max_memory_mb=1024):
+    #Same as "find_misorientation", but results are reused for identical "angles" within and across runs
+    #'max_gb' - size limit of "cache_dir", 'max_memory_mb' - size limit of the arrays kept in memory
+    #The array returned is shared with the cache and read-only, copy it before modifying it (e.g. "miso_array.copy()")
+    
+    key = miso_cache_key(angles, if_quat)
+    path = Path(cache_dir).joinpath(key + '.npy')
+    
+    if key in miso_memory_cache: 
+        miso_memory_cache.move_to_end(key)
+        if path.is_file(): os.utime(path)
+        return miso_memory_cache[key]
+    
+    if path.is_file(): 
+        os.utime(path) #mark as recently used
+        miso_array = np.load(path, mmap_mode='c')
+        print("LOADING CACHED MISORIENTATIONS: %s"%path)
+    else: 
+        miso_array = find_misorientation(angles, mem_max=mem_max, if_quat=if_quat, device=device)
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        path_tmp = Path(cache_dir).joinpath(key + '.tmp')
+        with open(path_tmp, 'wb') as f: np.save(f, miso_array)
+        os.replace(path_tmp, path) #only complete entries are ever visible in the cache
+        evict_cache(cache_dir, max_gb)
+    
+    miso_array.setflags(write=False) #so one caller can't change the values every later caller gets
+    miso_memory_cache[key] = miso_array
+    while len(miso_memory_cache)>0 and sum(a.nbytes for a in miso_memory_cache.values())>max_memory_mb*2**20: miso_memory_cache.popitem(last=False)
+    return miso_array
+
+
+class SparseMiso:
+    #Misorientations stored only for the grain pairs that are needed (neighbors), instead of a dense num_grains x num_grains "miso_matrix"
+    #Pairs are kept sorted by the key i*num_grains+j (i<j), values not yet stored are computed when first requested
+    #If "miso_array" is given values are read from it (kept on the CPU, only the values of new pairs go to "device"), otherwise they are calculated from "euler_angles" (radians either way)
+    #"run_primme" and "run_spparks" save the pairs that are neighbors in any frame, "lookup" still computes any other pair from "euler_angles"
+    
+    def __init__(self, euler_angles, miso_array=None, device=device):
+        self.device = device
+        self.num_grains = euler_angles.shape[0]
+        self.euler_angles = euler_angles
+        if miso_array is None: self.miso_array = None
+        elif torch.is_tensor(miso_array): self.miso_array = miso_array.cpu().numpy()
+        else: self.miso_array = np.asarray(miso_array)
+        self.q = euler2quaternion(torch.from_numpy(np.asarray(euler_angles)).to(device)).double()
+        self.sym_conj = symetric_quaternions_conj(device)
+        self.keys = torch.zeros(0, dtype=torch.long, device=device)
+        self.values = torch.zeros(0, dtype=torch.float64, device=device)
+    
+    def _sort_pairs(self, i, j):
+        i = torch.as_tensor(i, device=self.device).long().flatten()
+        j = torch.as_tensor(j, device=self.device).long().flatten()
+        return torch.minimum(i, j), torch.maximum(i, j)
+    
+    def _compute(self, i, j):
+        #Misorientations of pairs with i<j
+        if self.miso_array is not None: 
+            rows = (i+(j-1)*j//2).cpu().numpy() #same row order as "get_line"
+            return torch.from_numpy(self.miso_array[rows].astype('float64')).to(self.device)
+        return misorientation_kernel(self.q[i], self.q[j], self.sym_conj)
+    
+    def add_pairs(self, i, j):
+        #Stores the misorientations of the pairs (i, j) that are not already stored (self pairs are ignored)
+        i, j = self._sort_pairs(i, j)
+        keys = torch.unique(i[i!=j]*self.num_grains + j[i!=j])
+        keys = keys[~torch.isin(keys, self.keys)]
+        if len(keys)==0: return
+        values = self._compute(keys//self.num_grains, keys%self.num_grains)
+        self.keys, ii = torch.sort(torch.cat([self.keys, keys]))
+        self.values = torch.cat([self.values, values])[ii]
+    
+    def add_image(self, im, pad_mode='circular'):
+        #Stores the misorientations of every pair of neighboring grains in "im" (shape=(1,1,dim1,dim2) or (1,1,dim1,dim2,dim3))
+        pairs = find_unique_pairs(torch.as_tensor(im, device=self.device), pad_mode=pad_mode)
+        self.add_pairs(pairs[0], pairs[1])
+    
+    def lookup(self, i, j):
+        #Returns the misorientations of the pairs (i, j), any pair not yet stored is computed and stored first
+        shape = torch.as_tensor(i).shape
+        i, j = self._sort_pairs(i, j)
+        keys = i*self.num_grains + j
+        ii = torch.searchsorted(self.keys, keys).clamp(max=max(len(self.keys)-1, 0))
+        if len(self.keys)==0 or torch.any((self.keys[ii]!=keys)&(i!=j)): 
+            self.add_pairs(i, j)
+            ii = torch.searchsorted(self.keys, keys).clamp(max=max(len(self.keys)-1, 0))
+        if len(self.keys)==0: return torch.zeros(shape, dtype=torch.float64, device=self.device)
+        return torch.where(i==j, 0, self.values[ii]).reshape(shape)
+    
+    def save(self, g, name='miso_sparse'):
+        #Writes the stored pairs to h5 group "g" in COO form: "<name>/pairs" (2, number of pairs) and "<name>/miso" (radians)
+        if name in g.keys(): del g[name]
+        gs = g.create_group(name)
+        gs.attrs['num_grains'] = self.num_grains
+        tmp = np.array([8,16,32], dtype='uint64')
+        dtype = 'uint' + str(tmp[np.sum(self.num_grains>2**tmp)])
+        pairs = torch.stack([self.keys//self.num_grains, self.keys%self.num_grains]).cpu().numpy()
+        create_h5_dataset(gs, "pairs", data=pairs.astype(dtype))
+        create_h5_dataset(gs, "miso", data=self.values.cpu().numpy())
+    
+    @classmethod
+    def load(cls, g, name='miso_sparse', device=device):
+        #Reads the pairs written by "save" from h5 group "g", values not stored are computed from g['euler_angles']
+        sm = cls(g['euler_angles'][:], device=device)
+        pairs = torch.from_numpy(g[name+'/pairs'][:].astype('int64')).to(device)
+        sm.keys = pairs[0]*sm.num_grains + pairs[1]
+        sm.values = torch.from_numpy(g[name+'/miso'][:]).double().to(device)
+        return sm
+
+
 ### Statistical functions
 #Written by Kristien Everett, code optimized and added to by Joseph Melville 
 
@@ -915,23 +1650,62 @@ def find_grain_areas(im, max_id=19999):
     return areas
 
 
-def find_grain_num_neighbors(im, max_id=19999, if_AW=False):
-    #"im" is a torch.Tensor grain id image of shape=(1,1,dim1,dim2) (only one image at a time)
-    #'max_id' defines which grain id neighbors should be returned -> range(0,max_id+1)
-    #Outputs are of length 'max_id'+1 where each element corresponds to the respective grain id
+def pad_modes(pad_mode, dims):
+    #Returns the pad mode of each of the "dims" spatial dimensions, first dimension first
+    #A list "pad_mode" is given last dimension first and its last entry is copied if needed, as in "pad_mixed"
+    if type(pad_mode)!=list: return [pad_mode]*dims
+    pad_mode = pad_mode + [pad_mode[-1]]*(dims-len(pad_mode))
+    return pad_mode[:dims][::-1]
+
+
+def neighbor_pairs(ims, pad_mode="circular"):
+    #"ims" is a torch.Tensor of grain id images of shape=(num images,1,dim1,dim2,dim3(optional))
+    #Returns a tuple (a, b) for each spatial dimension, where "b" holds the next pixel along that dimension for each pixel in "a"
+    #These pairs cover every 4 (2D) or 6 (3D) neighbor pair once, since the previous pixel's pair is the next pixel pair of the previous pixel
+    #With "circular" the last pixel pairs with the first, with other modes (e.g. "reflect") there is no pair across the edge
+    #because reflected pixels only repeat pairs that are already inside the image
     
-    #Pad the images to define how pairs are made along the edges
-    im_pad = pad_mixed(im, [1,1,1,1], pad_mode="circular")
+    dims = ims.dim()-2
+    pairs = []
+    for d, mode in enumerate(pad_modes(pad_mode, dims)):
+        if mode=="circular": 
+            pairs.append((ims, torch.roll(ims, shifts=-1, dims=d+2)))
+        else: 
+            n = ims.shape[d+2]
+            pairs.append((ims.narrow(d+2, 0, n-1), ims.narrow(d+2, 1, n-1)))
+    return pairs
+
+
+def find_unique_pairs(im, pad_mode="circular"):
+    #"im" is a torch.Tensor grain id image of shape=(1,1,dim1,dim2,dim3(optional)) (only one image at a time)
+    #Returns every pair of neighboring grain ids once, shape=(2, number of pairs), smaller id first
     
     #Find all the unique id nieghbors pairs in the image
-    pl = torch.stack([im[0,0,].flatten(), im_pad[0,0,1:-1,0:-2].flatten()]) #left pairs
-    pr = torch.stack([im[0,0,].flatten(), im_pad[0,0,1:-1,2:].flatten()]) #right pairs
-    pu = torch.stack([im[0,0,].flatten(), im_pad[0,0,0:-2,1:-1].flatten()]) #up pairs
-    pd = torch.stack([im[0,0,].flatten(), im_pad[0,0,2:,1:-1].flatten()]) #down pairs
-    pairs = torch.hstack([pl,pr,pu,pd]) #list of all possible four neighbor pixel pairs in the image
+    pairs = torch.hstack([torch.stack([a.flatten(), b.flatten()]) for a, b in neighbor_pairs(im, pad_mode)]) #list of all possible neighbor pixel pairs in the image
     pairs_sort, _ = torch.sort(pairs, dim=0) #makes pair order not matter
     pairs_unique = torch.unique(pairs_sort, dim=1) #these pairs define every grain boundary uniquely (plus self pairs like [0,0]
     pairs_unique = pairs_unique[:, pairs_unique[0,:]!=pairs_unique[1,:]] #remove self pairs
+    return pairs_unique
+
+
+def find_aw(i, j, num_neighbors):
+    #Aboav-Weaire, the average number of neighbors of each grain's neighbors (zero for grains with no neighbors)
+    #"i" and "j" index every unique pair of neighbors once in "num_neighbors" (which can be flattened over several frames)
+    
+    n = num_neighbors.flatten()
+    total = torch.zeros(len(n), dtype=torch.float32, device=n.device)
+    total.index_add_(0, i, n[j].float()) #scatter the neighbor counts to both grains in each pair
+    total.index_add_(0, j, n[i].float())
+    AW = total/torch.clamp(n, min=1)
+    return AW.reshape(num_neighbors.shape)
+
+
+def find_grain_num_neighbors(im, max_id=19999, if_AW=False, pad_mode="circular"):
+    #"im" is a torch.Tensor grain id image of shape=(1,1,dim1,dim2,dim3(optional)) (only one image at a time)
+    #'max_id' defines which grain id neighbors should be returned -> range(0,max_id+1)
+    #Outputs are of length 'max_id'+1 where each element corresponds to the respective grain id (number of faces in 3D)
+    
+    pairs_unique = find_unique_pairs(im, pad_mode)
     
     #Find how many pairs are associated with each grain id
     search_ids = torch.arange(max_id+1).to(im.device) #these are the ids being serach, should include every id possibly in the image
@@ -939,13 +1713,7 @@ def find_grain_num_neighbors(im, max_id=19999, if_AW=False):
     num_neighbors = torch.unique(pairs_unique2, return_counts=True)[1]-1 #minus 1 to counteract the above concatenation
     
     if if_AW==True:
-        l = []
-        for ids in tqdm(range(max_id+1)):
-            if num_neighbors[ids]==0: l.append(0)
-            else:
-                i = (torch.sum(pairs_unique[:,torch.sum(pairs_unique==ids, dim=0)==1], dim=0)-ids).long()
-                l.append(torch.mean(num_neighbors[i].float()))
-        AW = torch.Tensor(l).to(im.device)
+        AW = find_aw(pairs_unique[0].long(), pairs_unique[1].long(), num_neighbors)
         return num_neighbors, AW
     else: 
         return num_neighbors
@@ -999,6 +1767,47 @@ def mean_wo_zeros(a):
     return torch.sum(a)/torch.sum(a!=0)
 
 
+def mean_wo_zeros_batch(a):
+    #"a" is a torch.Tensor of shape=(num frames, num values), returns the mean of the nonzero values in each frame
+    return torch.sum(a, dim=1)/torch.sum(a!=0, dim=1)
+
+
+def find_grain_areas_batch(ims, max_id=19999): 
+    #"ims" is a torch.Tensor of grain id images of shape=(num frames,1,dim1,dim2)
+    #Same as "find_grain_areas" for every frame at once, output shape=(num frames, max_id+1)
+    
+    n = ims.shape[0]
+    ids = ims.reshape(n, -1).long() + (max_id+1)*torch.arange(n, device=ims.device)[:,None] #offset the ids of each frame
+    areas = torch.bincount(ids.flatten(), minlength=n*(max_id+1)).reshape(n, max_id+1)
+    return areas
+
+
+def find_grain_num_neighbors_batch(ims, max_id=19999, if_AW=False, pad_mode="circular"):
+    #"ims" is a torch.Tensor of grain id images of shape=(num frames,1,dim1,dim2,dim3(optional))
+    #Same as "find_grain_num_neighbors" for every frame at once, output shape=(num frames, max_id+1)
+    
+    n = ims.shape[0]
+    m = max_id+1
+    ims = ims.long()
+    f = torch.arange(n, device=ims.device).reshape((-1,)+(1,)*(ims.dim()-1))
+    
+    #Encode every neighbor pair of every frame as one integer, (frame, smaller id, larger id)
+    #Each dimension is made unique before the next is found to limit memory
+    keys = []
+    for a, b in neighbor_pairs(ims, pad_mode): 
+        keys.append(torch.unique((f*m*m + torch.minimum(a,b)*m + torch.maximum(a,b))[a!=b])) #self pairs are not grain boundaries
+    keys = torch.unique(torch.cat(keys)) #each grain boundary of each frame once
+    
+    #Count the grain boundaries associated with each grain id in each frame
+    f = keys//(m*m)
+    i = f*m + (keys//m)%m
+    j = f*m + keys%m
+    num_neighbors = torch.bincount(torch.cat([i, j]), minlength=n*m).reshape(n, m)
+    
+    if if_AW==True: return num_neighbors, find_aw(i, j, num_neighbors)
+    else: return num_neighbors
+
+
 def iterate_function(array, func, args=[], device=device):
     
     #Iterate through the first dimension in "array" and apply "func" using "args"
@@ -1009,6 +1818,162 @@ def iterate_function(array, func, args=[], device=device):
         log.append(tmp)
     return np.stack(log)
 
+class IncrementalGrainStats:
+    #Tracks "grain_areas" and "grain_sides" through a sequence of grain id images by only looking at the pixels that changed
+    #"im" is a torch.Tensor grain id image of shape=(1,1,dim1,dim2) or (1,1,dim1,dim2,dim3), "pad_mode" as in "neighbor_pairs"
+    #The number of pixel pairs along each grain boundary (i<j) is kept as sorted keys i*(max_id+1)+j with counts
+    #A grain's number of sides is the number of boundaries with a nonzero count, it changes when a count becomes or stops being zero
+    
+    def __init__(self, im, max_id=19999, pad_mode="circular"):
+        self.max_id = max_id
+        self.size = im.shape[2:]
+        self.im = im.flatten().long().clone()
+        self.neighbors = self.neighbor_indices(torch.arange(len(self.im), device=im.device))
+        
+        # Pixels on the last edge of a non periodic dimension have no next pixel (marked -1)
+        coords = torch.unravel_index(torch.arange(len(self.im), device=im.device), tuple(self.size))
+        for d, mode in enumerate(pad_modes(pad_mode, len(self.size))):
+            if mode!="circular": self.neighbors[d][coords[d]==self.size[d]-1] = -1
+        
+        self.grain_areas = torch.bincount(self.im, minlength=max_id+1)
+        keys = torch.cat([self.pair_keys(self.im, d, self.neighbors[d]) for d in range(len(self.size))])
+        self.keys, self.counts = torch.unique(keys, return_counts=True)
+        m = max_id+1
+        self.grain_sides = torch.bincount(torch.cat([self.keys//m, self.keys%m]), minlength=m)
+    
+    def neighbor_indices(self, p, step=1):
+        #Flat index of the pixel "step" pixels away along each dimension from flat indices "p" (periodic)
+        coords = torch.stack(torch.unravel_index(p, tuple(self.size)))
+        strides = torch.tensor(np.cumprod((1,)+tuple(self.size[::-1]))[-2::-1].copy(), device=p.device)
+        nbs = []
+        for d in range(len(self.size)):
+            c = coords.clone()
+            c[d] = (c[d]+step)%self.size[d]
+            nbs.append(torch.sum(c*strides[:,None], dim=0))
+        return nbs
+    
+    def pair_keys(self, im, d, nb, p=None):
+        #Boundary keys of the pixel pairs (p, nb) along dimension "d", self pairs and pairs without a next pixel are removed
+        a = im if p==None else im[p]
+        b = im[nb.clamp(min=0)]
+        m = self.max_id+1
+        return (torch.minimum(a,b)*m + torch.maximum(a,b))[(a!=b)&(nb>=0)]
+    
+    def update(self, im_next):
+        #Updates the statistics to those of "im_next", the cost is proportional to the number of pixels that changed
+        
+        im_next = im_next.flatten().long()
+        changed = torch.nonzero(self.im!=im_next)[:,0]
+        if len(changed)==0: return self
+        
+        # Update areas by the pixels that flipped
+        self.grain_areas.index_add_(0, self.im[changed], -torch.ones_like(changed))
+        self.grain_areas.index_add_(0, im_next[changed], torch.ones_like(changed))
+        
+        # Find the pixel pairs that include a changed pixel, and their boundary keys before and after
+        keys_old = []
+        keys_new = []
+        prevs = self.neighbor_indices(changed, step=-1) #pixels whose next pixel changed
+        for d in range(len(self.size)):
+            p = torch.unique(torch.cat([changed, prevs[d]]))
+            keys_old.append(self.pair_keys(self.im, d, self.neighbors[d][p], p))
+            keys_new.append(self.pair_keys(im_next, d, self.neighbors[d][p], p))
+        keys_old = torch.cat(keys_old)
+        keys_new = torch.cat(keys_new)
+        
+        # Net change in the count of each affected boundary
+        keys, inverse = torch.unique(torch.cat([keys_new, keys_old]), return_inverse=True)
+        weights = torch.cat([torch.ones_like(keys_new), -torch.ones_like(keys_old)])
+        delta = torch.zeros_like(keys).index_add_(0, inverse, weights)
+        keys = keys[delta!=0]
+        delta = delta[delta!=0]
+        
+        # Insert boundaries that did not exist before
+        ii = torch.searchsorted(self.keys, keys).clamp(max=max(len(self.keys)-1, 0))
+        is_new = (self.keys[ii]!=keys) if len(self.keys)>0 else torch.ones_like(keys, dtype=bool)
+        if torch.any(is_new):
+            self.keys, jj = torch.sort(torch.cat([self.keys, keys[is_new]]))
+            self.counts = torch.cat([self.counts, torch.zeros_like(keys[is_new])])[jj]
+            ii = torch.searchsorted(self.keys, keys)
+        
+        # Update counts and the number of sides of grains whose boundaries appeared or disappeared
+        before = self.counts[ii]>0
+        self.counts[ii] += delta
+        after = self.counts[ii]>0
+        m = self.max_id+1
+        change = after.long()-before.long()
+        self.grain_sides.index_add_(0, keys//m, change)
+        self.grain_sides.index_add_(0, keys%m, change)
+        
+        self.im = im_next.clone()
+        return self
+    
+    def grain_areas_avg(self):
+        return mean_wo_zeros(self.grain_areas)
+    
+    def grain_sides_avg(self):
+        return mean_wo_zeros(self.grain_sides)
+    
+    def grain_aw(self):
+        m = self.max_id+1
+        keys = self.keys[self.counts>0]
+        return find_aw(keys//m, keys%m, self.grain_sides)
+
+
+def iterate_incremental(array, max_id=19999, outs=None, pad_mode="circular", device=device):
+    
+    #Iterate through the first dimension in "array" and track statistics with "IncrementalGrainStats"
+    #Writes grain_areas, grain_areas_avg, grain_sides, grain_sides_avg and grain_aw of each frame into "outs" ("None" discards that result)
+    
+    stats = None
+    for i in tqdm(range(array.shape[0]), 'In progress: IncrementalGrainStats'):
+        im = torch.from_numpy(array[i:i+1,][:].astype('int64')).to(device)
+        if stats==None: stats = IncrementalGrainStats(im, max_id, pad_mode)
+        else: stats.update(im)
+        results = [stats.grain_areas, stats.grain_areas_avg(), stats.grain_sides, stats.grain_sides_avg(), stats.grain_aw()]
+        for out, tmp in zip(outs, results): 
+            if out is not None: out[i] = tmp.cpu().numpy()
+    return outs
+
+
+def iterate_function_blocks(array, func, args=[], outs=None, block_size=64, num_workers=None, device=device):
+    
+    #Iterate through the first dimension in "array" in blocks of "block_size" and apply "func" using "args" to each block
+    #"func" returns a torch.Tensor (or list of them) with the block as the first dimension, written into the matching arrays in "outs" (e.g. h5 datasets)
+    #Blocks are read in this thread and processed by a pool of "num_workers" threads, only "num_workers" blocks are held at once
+    
+    if num_workers==None: num_workers = os.cpu_count() if torch.device(device).type=='cpu' else 1
+    
+    def process(i, block):
+        im = torch.from_numpy(block.astype('int64')).to(device)
+        results = func(im, *args)
+        if type(results)!=list: results = [results]
+        return i, [tmp.cpu().numpy() for tmp in results]
+    
+    def write(future):
+        i, results = future.result()
+        for out, tmp in zip(outs, results): 
+            if out is not None: out[i:i+len(tmp)] = tmp #"None" in "outs" discards that result
+    
+    starts = range(0, array.shape[0], block_size)
+    with ThreadPoolExecutor(num_workers) as pool:
+        futures = deque()
+        for i in tqdm(starts, 'In progress: %s'%func.__name__):
+            if len(futures)>=num_workers: write(futures.popleft())
+            futures.append(pool.submit(process, i, array[i:i+block_size]))
+        while len(futures)>0: write(futures.popleft())
+    
+    return outs
+
+
+def find_grain_stats_batch(ims, max_id=19999, pad_mode="circular"):
+    #Areas and number of neighbors of each grain in each frame of "ims", their averages over the grains present and Aboav-Weaire
+    #In 3D these are volumes and number of faces, see "find_grain_areas_batch" and "find_grain_num_neighbors_batch"
+    grain_areas = find_grain_areas_batch(ims, max_id)
+    grain_sides, grain_aw = find_grain_num_neighbors_batch(ims, max_id, if_AW=True, pad_mode=pad_mode)
+    return [grain_areas, mean_wo_zeros_batch(grain_areas), grain_sides, mean_wo_zeros_batch(grain_sides), grain_aw]
+
+
 def apply_color_map(ims, cmap='viridis'):
     '''
     Applies a colormap to a list of images.
@@ -1028,14 +1993,488 @@ def apply_color_map(ims, cmap='viridis'):
         colored_frames.append(colored_frame)
     return colored_frames
 
-def compute_grain_stats(hps, gps='sim0', device=device):
+def color_lut(num_ids, cmap='viridis', seed=0):
+    #Lookup table from grain id to color, the same for every frame
+    #Returns "lut" (num_ids,) uint8 index of each id into "palette" (256, 3) uint8 RGB, so "palette[lut[im]]" colors image "im"
+    #"seed" - colors are spread over the ids with a fixed random permutation so neighboring ids get different colors, None keeps id order
+    #"cmap" - any matplotlib colormap, or 'grayscale'
+    if cmap=='grayscale': palette = np.repeat(np.arange(256, dtype='uint8')[:,None], 3, 1)
+    else: palette = (plt.get_cmap(cmap)(np.linspace(0, 1, 256))[:,:3]*255).astype('uint8')
+    lut = np.round(np.linspace(0, 255, num_ids)).astype('uint8')
+    if seed!=None: lut = lut[np.random.default_rng(seed).permutation(num_ids)]
+    return lut, palette
+
+
+class GifStreamWriter:
+    #Writes a GIF one frame at a time (imageio keeps every frame in memory until the file is closed)
+    #Frames are uint8 indices into "palette" (256, 3), e.g. from "color_lut", so no color quantization is needed
+    #Use as imageio writers: "append_data(frame)" then "close()", or in a "with" statement
+    
+    def __init__(self, fp, palette, duration=100, loop=0):
+        self.f = open(fp, 'wb')
+        self.palette = palette.tobytes()
+        self.duration = duration
+        self.loop = loop
+        self.if_header = False
+    
+    def append_data(self, frame):
+        im = Image.fromarray(np.ascontiguousarray(frame, dtype='uint8'))
+        im.putpalette(self.palette)
+        if not self.if_header: 
+            header, _ = GifImagePlugin.getheader(im, info={'optimize': False, 'loop': self.loop, 'duration': self.duration})
+            self.f.write(b''.join(header))
+            self.if_header = True
+        self.f.write(b''.join(GifImagePlugin.getdata(im, duration=self.duration)))
+    
+    def close(self):
+        self.f.write(b';') #trailer
+        self.f.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+def mode_pool(ims, factor=2):
+    #Downsamples images "ims" (num images, dim1, dim2) by "factor" in each dimension, keeping the most common id in each block
+    #Unlike averaging this never creates ids that aren't there, so grain boundaries stay sharp, ties go to the first id in the block
+    #Dimensions that aren't a multiple of "factor" are cropped
+    if factor==1: return ims
+    n, h, w = ims.shape
+    h, w = h//factor, w//factor
+    b = ims[:, :h*factor, :w*factor].reshape(n, h, factor, w, factor).transpose(0, 1, 3, 2, 4).reshape(n, h, w, factor**2)
+    mode = b[..., 0].copy()
+    mode_count = (b==b[..., :1]).sum(-1)
+    for k in range(1, factor**2):
+        count = (b==b[..., k:k+1]).sum(-1)
+        ii = count>mode_count
+        mode[ii] = b[..., k][ii]
+        mode_count[ii] = count[ii]
+    return mode
+
+
+def preview_planes(d, t, slice_3d='mid'):
+    #Reads frames "t" (a slice) of "ims_id" "d" as a list of 2D planes (num frames, dim1, dim2), only the planes are read from an h5 dataset
+    #"slice_3d" - for 3D "d", 'mid' is the middle plane of the last dimension, 'ortho' adds the middle planes of the other two
+    if len(d.shape)==4: return [d[t, 0]]
+    x, y, z = [s//2 for s in d.shape[2:]]
+    if slice_3d=='mid': return [d[t, 0, :, :, z]]
+    elif slice_3d=='ortho': return [d[t, 0, :, :, z], d[t, 0, :, y, :], d[t, 0, x, :, :]]
+    else: raise Exception('Unknown 3D slice: %s'%slice_3d)
+
+
+def write_video(d, fps, num_ids, cmap='viridis', seed=0, mem_max=1, chunk_size=None, stride=1, downsample=1, max_res=None, slice_3d='mid', num_workers=None):
+    #Colors "ims_id" frames "d" (h5 dataset or array, shape=(num frames, 1, dim1, dim2) or (num frames, 1, dim1, dim2, dim3)) and writes them to every path in "fps" in one pass
+    #Frames are read "chunk_size" at a time (from "mem_max" in GB if not given), so memory does not grow with the number of frames
+    #Chunks are read in this thread, colored by a pool of "num_workers" threads and encoded in order by one more thread
+    #'.gif' paths are written with "GifStreamWriter", anything else with "imageio.get_writer" (e.g. '.mp4')
+    #"cmap", "seed" - see "color_lut"
+    #Previews: "stride" - use every "stride" frame, "downsample" - factor for "mode_pool", "max_res" - largest output side in pixels (increases "downsample" as needed)
+    #"slice_3d" - planes shown for 3D "d", see "preview_planes", 'ortho' places the three planes side by side
+    
+    if type(fps)!=list: fps = [fps]
+    if num_workers==None: num_workers = os.cpu_count()
+    lut, palette = color_lut(num_ids, cmap, seed)
+    
+    # Sizes of the planes read from each frame and of the output
+    s = d.shape[2:]
+    if len(s)==2: plane_shapes = [s]
+    elif slice_3d=='ortho': plane_shapes = [(s[0], s[1]), (s[0], s[2]), (s[1], s[2])]
+    else: plane_shapes = [(s[0], s[1])]
+    if max_res!=None: 
+        size = max(max(s[0] for s in plane_shapes), sum(s[1] for s in plane_shapes))
+        downsample = max(downsample, int(np.ceil(size/max_res)))
+    if chunk_size==None: #chunks being colored, plus two being encoded
+        bytes_per_frame = sum(np.prod(s) for s in plane_shapes)*(d.dtype.itemsize+1+3) #ids, color indices and RGB
+        chunk_size = max(1, int(mem_max*1e9/(num_workers+2)/bytes_per_frame))
+    ts = np.arange(0, d.shape[0], stride)
+    
+    writers = []
+    for fp in fps:
+        if os.path.splitext(fp)[1].lower()=='.gif': writers.append((GifStreamWriter(fp, palette), True))
+        else: writers.append((imageio.get_writer(fp), False))
+    if_rgb = not all(if_gif for _, if_gif in writers)
+    
+    def color(planes):
+        ims = [lut[mode_pool(p, downsample)] for p in planes]
+        if len(ims)>1: #side by side, shorter planes padded at the bottom with the first color
+            h = max(im.shape[1] for im in ims)
+            ims = np.concatenate([np.pad(im, ((0,0), (0,h-im.shape[1]), (0,0))) for im in ims], axis=2)
+        else: ims = ims[0]
+        return ims, palette[ims] if if_rgb else None
+    
+    def encode(ims, rgbs):
+        for j in range(ims.shape[0]):
+            for w, if_gif in writers: 
+                if if_gif: w.append_data(ims[j])
+                else: w.append_data(rgbs[j])
+    
+    try:
+        with ThreadPoolExecutor(num_workers) as pool, ThreadPoolExecutor(1) as encoder:
+            colored = deque()
+            encoded = deque()
+            def hand_over(): #the single encoder thread takes chunks in the order they were submitted
+                encoded.append(encoder.submit(encode, *colored.popleft().result()))
+                if len(encoded)>2: encoded.popleft().result()
+            for i in range(0, len(ts), chunk_size):
+                if len(colored)>=num_workers: hand_over()
+                t = slice(ts[i], ts[min(i+chunk_size, len(ts))-1]+1, stride)
+                colored.append(pool.submit(color, preview_planes(d, t, slice_3d)))
+            while len(colored)>0: hand_over()
+            while len(encoded)>0: encoded.popleft().result()
+    finally:
+        for w, _ in writers: w.close()
+
+
+class SparseFrameWriter:
+    #Writes frames of per grain statistics (shape=(num frames, num ids)) to h5 group "g/name" in a compressed CSR layout
+    #Only nonzero values are kept (e.g. grains that still exist): "indptr" (num frames+1), "ids" and "values" (number of nonzeros)
+    #Frames must be written in order, e.g. "writer[i:i+n] = block" or "writer[i] = frame", as with an h5 dataset
+    
+    def __init__(self, g, name, shape, dtype):
+        self.shape = shape
+        self.frame = 0
+        gs = g.create_group(name)
+        gs.attrs['shape'] = shape
+        tmp = np.array([8,16,32], dtype='uint64')
+        dtype_ids = 'uint' + str(tmp[np.sum(shape[1]>2**tmp)])
+        self.indptr = create_h5_dataset(gs, "indptr", shape=(shape[0]+1,), dtype='int64')
+        self.indptr[0] = 0
+        self.ids = create_h5_dataset(gs, "ids", shape=(0,), dtype=dtype_ids, maxshape=(None,))
+        self.values = create_h5_dataset(gs, "values", shape=(0,), dtype=dtype, maxshape=(None,))
+    
+    def __setitem__(self, key, block):
+        start = key.start if type(key)==slice else key
+        if start!=self.frame: raise Exception('Frames must be written in order, expected frame %d and got %d'%(self.frame, start))
+        block = np.asarray(block).reshape(-1, self.shape[1])
+        f, i = np.nonzero(block)
+        nnz = len(self.ids)
+        self.ids.resize((nnz+len(i),))
+        self.values.resize((nnz+len(i),))
+        self.ids[nnz:] = i
+        self.values[nnz:] = block[f, i]
+        self.indptr[self.frame+1:self.frame+len(block)+1] = nnz + np.cumsum(np.bincount(f, minlength=len(block)))
+        self.frame += len(block)
+
+
+class SparseFrames:
+    #Dense view of a group written by "SparseFrameWriter", indexing by frame (int or slice) returns dense numpy arrays
+    
+    def __init__(self, gs):
+        self.gs = gs
+        self.shape = tuple(gs.attrs['shape'])
+        self.dtype = gs['values'].dtype
+        self.indptr = gs['indptr'][:]
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __getitem__(self, key):
+        if type(key)!=slice: 
+            return self[key:key+1][0] if key>=0 else self[self.shape[0]+key]
+        start, stop, step = key.indices(self.shape[0])
+        if step!=1: return np.stack([self[i] for i in range(start, stop, step)])
+        stop = max(start, stop)
+        a, b = self.indptr[start], self.indptr[stop]
+        out = np.zeros((stop-start, self.shape[1]), dtype=self.dtype)
+        f = np.repeat(np.arange(stop-start), np.diff(self.indptr[start:stop+1]))
+        out[f, self.gs['ids'][a:b]] = self.gs['values'][a:b]
+        return out
+    
+    def astype(self, dtype):
+        return self[:].astype(dtype)
+    
+    def count_nonzero(self):
+        #Number of nonzero values in each frame, without reading them
+        return np.diff(self.indptr)
+
+
+def read_grain_stat(g, name):
+    #Returns the per grain statistic "name" of h5 group "g" as a dense h5 dataset or a "SparseFrames" view, both index by frame the same way
+    if isinstance(g[name], h5py.Group): return SparseFrames(g[name])
+    return g[name]
+
+
+def count_grain_stat_nonzero(g, name, block_size=64):
+    #Number of nonzero values (e.g. grains remaining) in each frame of the per grain statistic "name" of h5 group "g"
+    d = read_grain_stat(g, name)
+    if type(d)==SparseFrames: return d.count_nonzero()
+    return np.concatenate([(d[i:i+block_size]!=0).sum(1) for i in range(0, d.shape[0], block_size)])
+
+
+class DeltaFrameWriter:
+    #Writes grain id images (shape=(num frames, 1, dim1, dim2) or (num frames, 1, dim1, dim2, dim3)) to h5 group "g/name" as keyframes plus the pixels that flip in between
+    #"keys" - full frames 0, "key_freq", 2*"key_freq"..., "indptr" (num frames+1), "index" and "values" - flat index and new id of each pixel that changed from the previous frame
+    #Starts from frame "im0", then frames are appended in order with "append" (pixels that may have changed) or "append_data" (full frames), read with "DeltaFrames"
+    
+    def __init__(self, g, name, im0, dtype, key_freq=10):
+        self.frame_shape = np.shape(im0)
+        self.im = np.array(im0, dtype=dtype).ravel() #current frame
+        self.key_freq = key_freq
+        self.frame = 0
+        self.buffer = [] #(index, values) of each frame since the last keyframe
+        if name.split('/')[-1]=='ims_id': frame_cache.clear(g.file.filename)
+        self.gs = g.create_group(name)
+        self.gs.attrs['key_freq'] = key_freq
+        tmp = np.array([8,16,32], dtype='uint64')
+        dtype_index = 'uint' + str(tmp[np.sum(self.im.size>2**tmp)])
+        self.keys = create_h5_dataset(self.gs, "keys", shape=(0,)+self.frame_shape, maxshape=(None,)+self.frame_shape, dtype=dtype, sample_dims=1)
+        self.indptr = create_h5_dataset(self.gs, "indptr", shape=(2,), dtype='int64', maxshape=(None,)) #frame 0 has no changes
+        self.index = create_h5_dataset(self.gs, "index", shape=(0,), dtype=dtype_index, maxshape=(None,))
+        self.values = create_h5_dataset(self.gs, "values", shape=(0,), dtype=dtype, maxshape=(None,))
+        self.write_key()
+    
+    def append(self, index, values):
+        #Appends the next frame from the flat "index" of pixels that may have changed and their new "values" (e.g. "PRIMME.step" "indx_use" and the updated ids)
+        index = np.asarray(index, dtype='int64').ravel()
+        values = np.asarray(values).ravel().astype(self.im.dtype)
+        i = values!=self.im[index]
+        index, values = index[i], values[i]
+        self.im[index] = values
+        self.buffer.append((index, values))
+        self.frame += 1
+        if self.frame%self.key_freq==0: self.write_key()
+    
+    def append_data(self, im):
+        #Appends the next frame from the full image "im"
+        im = np.asarray(im).ravel()
+        index = np.flatnonzero(im!=self.im)
+        self.append(index, im[index])
+    
+    def flush(self):
+        #Writes the buffered pixel changes
+        if len(self.buffer)==0: return
+        index = np.concatenate([b[0] for b in self.buffer])
+        values = np.concatenate([b[1] for b in self.buffer])
+        nnz = self.index.shape[0]
+        self.index.resize((nnz+len(index),))
+        self.values.resize((nnz+len(index),))
+        self.index[nnz:] = index
+        self.values[nnz:] = values
+        n = self.indptr.shape[0]
+        self.indptr.resize((n+len(self.buffer),))
+        self.indptr[n:] = nnz + np.cumsum([len(b[0]) for b in self.buffer])
+        self.buffer = []
+    
+    def write_key(self):
+        self.flush()
+        k = self.keys.shape[0]
+        self.keys.resize((k+1,)+self.frame_shape)
+        self.keys[k] = self.im.reshape(self.frame_shape)
+    
+    def close(self):
+        self.flush()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+
+
+class DeltaFrames:
+    #Dense view of a group written by "DeltaFrameWriter", indexes like the h5 dataset it replaces (e.g. "d[t]", "d[i:j]", "d[t, 0, :, :, z]")
+    #Each frame is rebuilt from the keyframe before it, or from the previous frame read when that is closer, so reading frames in order is cheap
+    
+    def __init__(self, gs):
+        self.gs = gs
+        self.key_freq = int(gs.attrs['key_freq'])
+        self.indptr = gs['indptr'][:]
+        self.shape = (len(self.indptr)-1,) + gs['keys'].shape[1:]
+        self.dtype = gs['keys'].dtype
+        self.ndim = len(self.shape)
+        self.im, self.t = None, -1 #last frame rebuilt, so reading frame by frame does not go back to the keyframe each time
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def iterate(self, frames):
+        #Yields frames "frames" (increasing), the same array is updated in place between frames
+        im, t0 = (None, -1) if self.im is None else (self.im.copy(), self.t)
+        for t in frames:
+            k = t//self.key_freq
+            if im is None or t<t0 or k*self.key_freq>t0: 
+                im = self.gs['keys'][k].ravel()
+                t0 = k*self.key_freq
+            a, b = self.indptr[t0+1], self.indptr[t+1]
+            if b>a:
+                index = self.gs['index'][a:b]
+                values = self.gs['values'][a:b]
+                cuts = self.indptr[t0+1:t+2] - a
+                for j in range(t-t0): im[index[cuts[j]:cuts[j+1]]] = values[cuts[j]:cuts[j+1]] #in order, a pixel can flip more than once
+            t0 = t
+            self.im, self.t = im, t
+            yield im.reshape(self.shape[1:])
+    
+    def __getitem__(self, key):
+        if type(key)==tuple: 
+            ims = self[key[0]]
+            return ims[(slice(None),)+key[1:]] if type(key[0])==slice else ims[key[1:]]
+        if type(key)!=slice: 
+            return self[key:key+1][0] if key>=0 else self[self.shape[0]+key]
+        frames = range(*key.indices(self.shape[0]))
+        out = np.zeros((len(frames),)+self.shape[1:], dtype=self.dtype)
+        for j, im in enumerate(self.iterate(frames)): out[j] = im
+        return out
+    
+    def astype(self, dtype):
+        return self[:].astype(dtype)
+
+
+def read_ims_id(g):
+    #Returns "ims_id" of h5 group "g" as an h5 dataset or a "DeltaFrames" view (written by "DeltaFrameWriter"), both index by frame the same way
+    if isinstance(g['ims_id'], h5py.Group): return DeltaFrames(g['ims_id'])
+    return g['ims_id']
+
+
+class FrameCache:
+    #Bounded LRU cache of decoded "ims_id" frames keyed by (run, frame number), least recently used frames are evicted first past "max_mb"
+    #The module level "frame_cache" is shared by every "Trajectory", so passes over the same run by different functions read the disk once
+    
+    def __init__(self, max_mb=1024):
+        self.max_mb = max_mb
+        self.frames = OrderedDict()
+        self.nbytes = 0
+        self.lock = threading.Lock() #frames are read from worker threads, e.g. "write_video"
+    
+    def get(self, key):
+        with self.lock:
+            if key not in self.frames: return None
+            self.frames.move_to_end(key)
+            return self.frames[key]
+    
+    def put(self, key, im):
+        #"im" is made read-only, so views handed out from the cache cannot change it for later readers
+        if im.nbytes>self.max_mb*2**20: return
+        im.setflags(write=False)
+        with self.lock:
+            if key in self.frames: self.nbytes -= self.frames.pop(key).nbytes
+            self.frames[key] = im
+            self.nbytes += im.nbytes
+            while self.nbytes>self.max_mb*2**20: self.nbytes -= self.frames.popitem(last=False)[1].nbytes
+    
+    def clear(self, fp=None):
+        #Removes the frames of file "fp" (e.g. when its "ims_id" is rewritten), or every frame
+        with self.lock:
+            for key in list(self.frames.keys()):
+                if fp==None or key[0][0]==os.path.realpath(fp): self.nbytes -= self.frames.pop(key).nbytes
+    
+    def rekey(self, run, new_run):
+        #Moves the frames of "run" to "new_run", keeping their order of use
+        with self.lock:
+            self.frames = OrderedDict(((new_run, key[1]) if key[0]==run else key, im) for key, im in self.frames.items())
+
+
+frame_cache = FrameCache()
+
+
+def file_state(fp):
+    #Modification time and size of file "fp", part of the "Trajectory" cache key so frames cached before another process rewrote the file are not used
+    st = os.stat(fp)
+    return (st.st_mtime_ns, st.st_size)
+
+
+class Trajectory:
+    #Lazy view of "ims_id" of h5 group "g" (an h5 dataset or a "DeltaFrameWriter" group), nothing is read until it is indexed
+    #Indexes like a numpy array, frames first: "tr[t]", "tr[i:j]", "tr[[t0, t1]]", "tr[t, 0, x0:x1, y0:y1]"
+    #"time_slice" selects frames by time, e.g. "tr[tr.time_slice(100, 200), 0, :64, :64]", "tensor" returns torch tensors
+    #Frames are decoded once into "cache" ("frame_cache" if not given), missing frames are read in contiguous blocks
+    #Spatial windows of frames not cached are read from an h5 dataset directly (only the window, e.g. one plane of a 3D frame) and are not cached
+    #A single frame "tr[t, ...]" is a read-only view of the cached frame (no copy), copy it to modify it
+    #Frames are cached under the file's modification time and size, call "keep_cache" after writing other datasets to the file (e.g. statistics)
+    
+    def __init__(self, g, cache=None):
+        self.d = read_ims_id(g)
+        self.cache = frame_cache if cache==None else cache
+        self.shape = tuple(self.d.shape)
+        self.dtype = self.d.dtype
+        self.ndim = len(self.shape)
+        self.timesteps = g['timesteps'][:] if 'timesteps' in g.keys() else None
+        addr = h5py.h5o.get_info(g['ims_id'].id).addr #with the shape, tells apart runs rewritten to the same file
+        fp = os.path.realpath(g.file.filename)
+        self.run = (fp, g.name, addr, self.shape, str(self.dtype), file_state(fp))
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def keep_cache(self):
+        #Keeps the cached frames valid after this process wrote datasets other than "ims_id" to the file (call once the file is closed)
+        run = self.run[:-1]+(file_state(self.run[0]),)
+        self.cache.rekey(self.run, run)
+        self.run = run
+    
+    def frames(self, ts, window=()):
+        #Returns frames "ts" (frame numbers) cut to "window" as a list of arrays, runs of missing frames are read as one block
+        #Missing frames are cached whole, unless "window" is part of a frame of an h5 dataset, then only the window is read and it is not cached
+        frame_shape = self.shape[1:]
+        partial = type(self.d)!=DeltaFrames and np.broadcast_to(False, frame_shape)[window].size<np.prod(frame_shape)
+        ims = [self.cache.get((self.run, t)) for t in ts]
+        missing = [t for t, im in zip(ts, ims) if im is None]
+        step = ts[1]-ts[0] if len(ts)>1 and ts[1]>ts[0] else 1
+        read = {}
+        i = 0
+        while i<len(missing): 
+            j = i+1
+            while j<len(missing) and missing[j]==missing[j-1]+step: j += 1
+            if partial:
+                block = self.d[(slice(missing[i], missing[j-1]+1, step),)+window]
+                read.update(zip(missing[i:j], block))
+            else:
+                block = self.d[missing[i]:missing[j-1]+1:step]
+                for t, im in zip(missing[i:j], block):
+                    im = im.copy() #copies, so evicted frames free their memory
+                    self.cache.put((self.run, t), im)
+                    read[t] = im[window]
+            i = j
+        return [im[window] if im is not None else read[t] for t, im in zip(ts, ims)]
+    
+    def __getitem__(self, key):
+        if type(key)!=tuple: key = (key,)
+        t, window = key[0], key[1:]
+        if type(t)==slice: ts = range(*t.indices(self.shape[0]))
+        elif isinstance(t, (list, np.ndarray)): ts = [int(i)%self.shape[0] for i in t]
+        else: 
+            t = int(t)
+            if t<0: t += self.shape[0]
+            if t<0 or t>=self.shape[0]: raise IndexError('Frame %d is out of range for %d frames'%(int(key[0]), self.shape[0]))
+            return self.frames([t], window)[0]
+        if len(ts)==0: return np.zeros((0,)+self.shape[1:], dtype=self.dtype)[(slice(None),)+window]
+        return np.stack(self.frames(ts, window))
+    
+    def astype(self, dtype):
+        return self[:].astype(dtype)
+    
+    def time_slice(self, t0=None, t1=None):
+        #Slice of the frames with times in [t0, t1], from "timesteps" if the run saved them (e.g. SPPARKS), otherwise frame numbers
+        times = self.timesteps if self.timesteps is not None else np.arange(self.shape[0])
+        i = 0 if t0==None else int(np.searchsorted(times, t0, 'left'))
+        j = len(times) if t1==None else int(np.searchsorted(times, t1, 'right'))
+        return slice(i, j)
+    
+    def tensor(self, key, device=device):
+        #Returns "self[key]" as a torch tensor, which shares memory with the numpy array on the CPU unless it is a read-only cached frame or the dtype has no torch equivalent (unsigned above 8 bits)
+        im = self[key]
+        if im.dtype.kind=='u' and im.dtype.itemsize>1: im = im.astype('int64')
+        if not im.flags.writeable: return torch.tensor(im, device=device) #copy, so the tensor cannot change the cache
+        return torch.from_numpy(im).to(device)
+
+
+def compute_grain_stats(hps, gps='sim0', pad_mode='circular', mem_max=1, block_size=None, num_workers=None, if_incremental=False, if_sparse=True, device=device):
+    #Works for 2D and 3D "ims_id", in 3D "grain_areas" are grain volumes and "grain_sides" are number of faces
+    #"ims_id" is read through "Trajectory", so frames decoded here are reused by "track_grains" and "make_videos" while they fit in "frame_cache"
+    #"pad_mode" - boundary conditions, "circular" (periodic) or "reflect", can be a list per dimension as in "pad_mixed"
+    #"mem_max" - approximate memory (GB) used for blocks of frames, unless "block_size" (frames per block) is given
+    #"if_incremental" - track statistics from frame to frame with "IncrementalGrainStats" instead of computing each block of frames from scratch
+    #"if_sparse" - save the per grain statistics with "SparseFrameWriter" (only grains that exist), read them with "read_grain_stat"
     
     #Make 'hps' and 'gps' a list if it isn't already
     if type(hps)!=list: hps = [hps]
     if type(gps)!=list: gps = [gps]
     
     #Make sure the files needed actually exist
-    dts = ['ims_id', 'euler_angles', 'miso_matrix']
+    dts = ['ims_id', 'euler_angles']
     check_exist_h5(hps, gps, dts, if_bool=False)
     
     for i in range(len(hps)):
@@ -1047,258 +2486,463 @@ def compute_grain_stats(hps, gps='sim0', device=device):
             
             # Setup
             g = f[gp]
-            d = g['ims_id']
+            d = Trajectory(g)
             max_id = g['euler_angles'].shape[0] - 1
+            names = ['grain_areas', 'grain_areas_avg', 'grain_sides', 'grain_sides_avg', 'grain_aw']
+            shapes = [(d.shape[0], max_id+1), (d.shape[0],)]*2 + [(d.shape[0], max_id+1)]
+            dtypes = ['int64', 'float32']*2 + ['float32']
             
-            # Find number of pixels per grain
-            if 'grain_areas' not in g.keys():
-                args = [max_id]
-                func = find_grain_areas
-                grain_areas = iterate_function(d, func, args)
-                g['grain_areas'] = grain_areas
-                print('Calculated: grain_areas')
-            else: grain_areas = None
-                
-            # Find average number of pixels per grain
-            if 'grain_areas_avg' not in g.keys():
-                if np.all(grain_areas==None): grain_areas = g['grain_areas']
-                func = mean_wo_zeros
-                grain_areas_avg = iterate_function(grain_areas, func, args=[])
-                g['grain_areas_avg'] = grain_areas_avg
-                print('Calculated: grain_areas_avg')
+            # Choose how many frames to process at once for this file, about 8 bytes per pixel for the image and 40 more per dimension for the pairs
+            nw, bs = num_workers, block_size
+            if nw==None: nw = os.cpu_count() if torch.device(device).type=='cpu' else 1
+            if bs==None: 
+                dims = len(d.shape)-2
+                bytes_per_frame = np.prod(d.shape[1:])*(8+40*dims)
+                bs = max(1, int(mem_max*1e9/nw/bytes_per_frame))
             
-            # Find number of neighbors per grain
-            if 'grain_sides' not in g.keys():
-                args = [max_id]
-                func = find_grain_num_neighbors
-                grain_sides = iterate_function(d, func, args)
-                g['grain_sides'] = grain_sides
-                print('Calculated: grain_sides')
-            else: grain_sides = None
-                
-            # Find average number of neighbors per grain
-            if 'grain_sides_avg' not in g.keys():
-                if np.all(grain_sides==None): grain_sides = g['grain_sides']
-                func = mean_wo_zeros
-                grain_sides_avg = iterate_function(grain_sides, func, args=[])
-                g['grain_sides_avg'] = grain_sides_avg
-                print('Calculated: grain_sides_avg')
-
-def make_videos(hps, ic_shape, sub_folder="", gps='sim0'):
-    # Run "compute_grain_stats" before this function
+            # Find number of pixels, number of neighbors and Aboav-Weaire per grain and the averages, reading blocks of frames once for all
+            if 'grain_areas' not in g.keys() or 'grain_sides' not in g.keys() or 'grain_aw' not in g.keys():
+                outs = []
+                for n, sh, dt in zip(names, shapes, dtypes):
+                    if n in g.keys(): outs.append(None)
+                    elif if_sparse and len(sh)==2: outs.append(SparseFrameWriter(g, n, sh, dt))
+                    else: outs.append(create_h5_dataset(g, n, shape=sh, dtype=dt))
+                if if_incremental: 
+                    iterate_incremental(d, max_id, outs, pad_mode, device)
+                else: 
+                    args = [max_id, pad_mode]
+                    func = find_grain_stats_batch
+                    iterate_function_blocks(d, func, args, outs, bs, nw, device)
+                for n, out in zip(names, outs): 
+                    if out is not None: print('Calculated: %s'%n)
+            
+            # Find averages that are still missing (files where only the per grain statistics were saved)
+            for n in ['grain_areas', 'grain_sides']:
+                if n+'_avg' not in g.keys():
+                    out = create_h5_dataset(g, n+'_avg', shape=(d.shape[0],), dtype='float32')
+                    func = mean_wo_zeros_batch
+                    iterate_function_blocks(read_grain_stat(g, n), func, [], [out], bs, nw, device)
+                    print('Calculated: %s_avg'%n)
+        
+        d.keep_cache() #the statistics written do not change "ims_id"
+
+def track_grains(hps, gps='sim0', pad_mode='circular', mem_max=1, device=device):
+    #Follows every grain through "ims_id" in one pass and saves its lifetime, area history, number of sides history and neighbors
+    #Records are appended to the file as frames are processed, so memory does not grow with the number of frames
+    #Written to the h5 group "grain_tracks", read it with "GrainTracks":
+    #   "birth", "death" (num ids) - first frame each grain exists and the frame after its last (-1 if never)
+    #   "frame_indptr", "frame_ids", "frame_areas", "frame_sides" - records ordered by frame, then grain id
+    #   "pair_indptr", "pairs" (number of boundaries, 2) - ids of every pair of neighboring grains (smaller first) in each frame
+    #   "grain_indptr", "grain_frames", "grain_areas", "grain_sides" - the records ordered by grain id, then frame
+    #"mem_max" - approximate memory (GB) for records, used to buffer them while tracking and to reorder them by grain afterwards
     
     #Make 'hps' and 'gps' a list if it isn't already
     if type(hps)!=list: hps = [hps]
     if type(gps)!=list: gps = [gps]
     
+    #Make sure the files needed actually exist
+    dts = ['ims_id', 'euler_angles']
+    check_exist_h5(hps, gps, dts, if_bool=False)
+    
+    num_records = max(1, int(mem_max*1e9/64)) #records held at once, about 8 bytes for each of their fields plus the sort
+    
+    def append(d, a):
+        n = d.shape[0]
+        d.resize(n+len(a), axis=0)
+        d[n:] = a
+    
+    for i in range(len(hps)):
+        hp = hps[i]
+        gp = gps[i]
+        print('Tracking grains for: %s/%s'%(hp,gp))
+            
+        d = None
+        with h5py.File(hp, 'a') as f:
+            
+            g = f[gp]
+            if 'grain_tracks' in g.keys(): continue
+            d = Trajectory(g)
+            max_id = g['euler_angles'].shape[0] - 1
+            num_frames = d.shape[0]
+            tmp = np.array([8,16,32], dtype='uint64')
+            dtype_ids = 'uint' + str(tmp[np.sum(max_id+1>2**tmp)])
+            gs = g.create_group('grain_tracks')
+            gs.attrs['shape'] = (num_frames, max_id+1)
+            names = ['frame_ids', 'frame_areas', 'frame_sides', 'pairs']
+            shapes = [(0,)]*3 + [(0, 2)]
+            dtypes = [dtype_ids, 'int64', 'int64', dtype_ids]
+            outs = [create_h5_dataset(gs, n, shape=sh, dtype=dt, maxshape=(None,)+sh[1:], sample_dims=0) for n, sh, dt in zip(names, shapes, dtypes)]
+            
+            # Record the id, area, number of sides and neighbors of every grain that exists in each frame, written a buffer at a time
+            birth = -np.ones(max_id+1, dtype='int64')
+            death = -np.ones(max_id+1, dtype='int64')
+            counts, pair_counts, grain_counts = [], [], np.zeros(max_id+1, dtype='int64')
+            buffers = [[] for _ in outs]
+            m = max_id+1
+            stats = None
+            for t in tqdm(range(num_frames), 'Tracking grains'):
+                im = torch.from_numpy(d[t:t+1].astype('int64')).to(device)
+                if stats==None: stats = IncrementalGrainStats(im, max_id, pad_mode)
+                else: stats.update(im)
+                alive = torch.nonzero(stats.grain_areas)[:,0]
+                keys = stats.keys[stats.counts>0]
+                ids = alive.cpu().numpy()
+                buffers[0].append(ids)
+                buffers[1].append(stats.grain_areas[alive].cpu().numpy())
+                buffers[2].append(stats.grain_sides[alive].cpu().numpy())
+                buffers[3].append(torch.stack([keys//m, keys%m], dim=1).cpu().numpy())
+                counts.append(len(ids))
+                pair_counts.append(len(keys))
+                grain_counts[ids] += 1
+                birth[ids[birth[ids]<0]] = t
+                death[ids] = t+1
+                if sum(len(b) for b in buffers[0])+sum(len(b) for b in buffers[3])>=num_records or t==num_frames-1:
+                    for out, b in zip(outs, buffers): append(out, np.concatenate(b))
+                    buffers = [[] for _ in outs]
+            
+            frame_indptr = np.concatenate([[0], np.cumsum(counts)])
+            grain_indptr = np.concatenate([[0], np.cumsum(grain_counts)])
+            create_h5_dataset(gs, 'birth', data=birth)
+            create_h5_dataset(gs, 'death', data=death)
+            create_h5_dataset(gs, 'frame_indptr', data=frame_indptr)
+            create_h5_dataset(gs, 'pair_indptr', data=np.concatenate([[0], np.cumsum(pair_counts)]))
+            create_h5_dataset(gs, 'grain_indptr', data=grain_indptr)
+            
+            # Reorder the records by grain from those on disk, for a range of grain ids at a time so at most "num_records" are in memory
+            n = frame_indptr[-1]
+            grain_outs = [create_h5_dataset(gs, nm, shape=(n,), dtype='int64') for nm in ['grain_frames', 'grain_areas', 'grain_sides']]
+            g0 = 0
+            while g0<m:
+                g1 = min(m, max(g0+1, int(np.searchsorted(grain_indptr, grain_indptr[g0]+num_records, 'right'))-1))
+                ids, records = [], [[] for _ in grain_outs]
+                for r in range(0, n, num_records):
+                    tmp = gs['frame_ids'][r:r+num_records].astype('int64')
+                    ii = np.nonzero((tmp>=g0)&(tmp<g1))[0]
+                    ids.append(tmp[ii])
+                    records[0].append(np.searchsorted(frame_indptr, r+ii, 'right')-1) #frame of each record
+                    records[1].append(gs['frame_areas'][r:r+num_records][ii])
+                    records[2].append(gs['frame_sides'][r:r+num_records][ii])
+                order = np.argsort(np.concatenate(ids), kind='stable') #by grain, frames stay in order
+                for out, rec in zip(grain_outs, records): 
+                    if len(order)>0: out[grain_indptr[g0]:grain_indptr[g1]] = np.concatenate(rec)[order]
+                g0 = g1
+            print('Calculated: grain_tracks')
+        
+        if d is not None: d.keep_cache() #the tracks written do not change "ims_id"
+
+
+class GrainTracks:
+    #Queries of the h5 group written by "track_grains", e.g. GrainTracks(f['sim0/grain_tracks'])
+    
+    def __init__(self, gs):
+        self.gs = gs
+        self.shape = tuple(gs.attrs['shape'])
+        self.birth = gs['birth'][:]
+        self.death = gs['death'][:]
+        self.frame_indptr = gs['frame_indptr'][:]
+        self.grain_indptr = gs['grain_indptr'][:]
+        self.pair_indptr = gs['pair_indptr'][:] if 'pair_indptr' in gs.keys() else None #not in files tracked before neighbors were saved
+    
+    def alive(self, t, num_sides=None):
+        #Ids, areas and number of sides of all grains that exist in frame "t", only those with "num_sides" sides if given
+        a, b = self.frame_indptr[t], self.frame_indptr[t+1]
+        ids = self.gs['frame_ids'][a:b].astype('int64')
+        areas = self.gs['frame_areas'][a:b]
+        sides = self.gs['frame_sides'][a:b]
+        if num_sides!=None: 
+            ii = sides==num_sides
+            ids, areas, sides = ids[ii], areas[ii], sides[ii]
+        return ids, areas, sides
+    
+    def neighbors(self, t, gid=None):
+        #Pairs of neighboring grain ids (num pairs, 2) in frame "t", or the ids of the neighbors of grain "gid" in frame "t"
+        a, b = self.pair_indptr[t], self.pair_indptr[t+1]
+        pairs = self.gs['pairs'][a:b].astype('int64')
+        if gid==None: return pairs
+        return np.sort(np.concatenate([pairs[pairs[:,0]==gid,1], pairs[pairs[:,1]==gid,0]]))
+    
+    def neighbor_history(self, gid):
+        #Frames and neighbor ids of grain "gid" through its lifetime, one row per neighbor per frame (ordered by frame, then neighbor id)
+        t0, t1 = self.birth[gid], self.death[gid]
+        if t0<0: return np.zeros(0, dtype='int64'), np.zeros(0, dtype='int64')
+        a, b = self.pair_indptr[t0], self.pair_indptr[t1]
+        pairs = self.gs['pairs'][a:b].astype('int64')
+        frames = np.repeat(np.arange(t0, t1), np.diff(self.pair_indptr[t0:t1+1]))
+        ii = (pairs[:,0]==gid) | (pairs[:,1]==gid)
+        return frames[ii], pairs[ii].sum(1)-gid
+    
+    def history(self, gid):
+        #Frames, areas and number of sides of grain "gid" through its lifetime
+        a, b = self.grain_indptr[gid], self.grain_indptr[gid+1]
+        return self.gs['grain_frames'][a:b], self.gs['grain_areas'][a:b], self.gs['grain_sides'][a:b]
+    
+    def growth_rates(self):
+        #Area change to the next frame (dA/dt) against number of sides, for every record whose grain still exists in the next frame
+        #Useful to check von Neumann-Mullins (dA/dt proportional to n-6 in 2D)
+        frames = self.gs['grain_frames'][:]
+        areas = self.gs['grain_areas'][:].astype('float64')
+        sides = self.gs['grain_sides'][:]
+        ids = np.repeat(np.arange(len(self.grain_indptr)-1), np.diff(self.grain_indptr))
+        same = (ids[1:]==ids[:-1]) & (np.diff(frames)==1) #the next record is the same grain in the next frame
+        return sides[:-1][same], np.diff(areas)[same]
+
+
+def make_videos(hps, ic_shape, sub_folder="", gps='sim0', cmap='viridis', seed=0, mem_max=1, stride=1, downsample=1, max_res=None, slice_3d='mid', num_workers=None):
+    # Run "compute_grain_stats" before this function
+    # Frames are streamed from the file to an mp4 and a gif at once, see "write_video" (colors and previews) and "color_lut" ("cmap", "seed")
+    
+    #Make 'hps' and 'gps' a list if it isn't already
+    if type(hps)!=list: hps = [hps]
+    if type(gps)!=list: gps = [gps]*len(hps)
+    
     # Make sure all needed datasets exist
     #dts=['ims_id', 'ims_miso', 'ims_miso_spparks']
     #check_exist_h5(hps, gps, dts)  
-    if sub_folder:
-        for i in tqdm(range(len(hps)), "Making videos"):
-            with h5py.File(hps[i], 'a') as f:
-                g = f[gps[i]]
-                ims = g['ims_id'][:,0]
-                # Create colored frames
-                ims = apply_color_map(ims, cmap='viridis')
-                imageio.mimsave('./plots/%s/%s_ims_id%d.mp4'%(sub_folder, ic_shape, i), ims)
-                imageio.mimsave('./plots/%s/%s_ims_id%d.gif'%(sub_folder, ic_shape, i), ims)
-    else:
-        for i in tqdm(range(len(hps)), "Making videos"):
-            with h5py.File(hps[i], 'a') as f:
-                g = f[gps[i]]
-                ims = g['ims_id'][:,0]
-                ims = apply_color_map(ims, cmap='viridis')
-                imageio.mimsave('./plots/%s_ims_id%d.mp4'%(ic_shape, i), ims)
-                imageio.mimsave('./plots/%s_ims_id%d.gif'%(ic_shape, i), ims)
-
-def make_time_plots(hps, ic_shape, sub_folder="", legend = [], gps='last', scale_ngrains_ratio=0.05, cr=None, if_plot=True):
+    if sub_folder: fp = './plots/%s/'%sub_folder
+    else: fp = './plots/'
+    for i in tqdm(range(len(hps)), "Making videos"):
+        with h5py.File(hps[i], 'r') as f:
+            g = f[gps[i]]
+            d = Trajectory(g)
+            if 'euler_angles' in g.keys(): num_ids = g['euler_angles'].shape[0]
+            else: num_ids = int(d[0].max())+1 #ids only disappear as grains grow
+            fps = ['%s%s_ims_id%d.mp4'%(fp, ic_shape, i), '%s%s_ims_id%d.gif'%(fp, ic_shape, i)]
+            write_video(d, fps, num_ids, cmap, seed, mem_max, None, stride, downsample, max_res, slice_3d, num_workers)
+
+def summarize_run(g, scale_ngrains_ratio=0.05, frac=0.25):
+    #Finds the series "make_time_plots" compares between runs from the statistics in h5 group "g" (run "compute_grain_stats" first)
+    #Returns a dictionary of small arrays, the raw "ims_id" is never read
+    #"scale_ngrains_ratio" - the scaled plots stop when the average area reaches the area of this fraction of the initial grains
+    #"frac" - the distributions are taken from the first frame with less than this fraction of the initial grains
+    
+    total_area = np.prod(read_ims_id(g).shape[1:])
+    grain_areas = read_grain_stat(g, 'grain_areas')
+    grain_sides = read_grain_stat(g, 'grain_sides')
+    ngrains = grain_areas.shape[1]
+    lim = total_area/(ngrains*scale_ngrains_ratio)
+    s = {}
+    
+    # Average grain area and number of sides through time, and linear slopes
+    grain_areas_avg = g['grain_areas_avg'][:]
+    s['grain_areas_avg'] = grain_areas_avg
+    s['grain_sides_avg'] = g['grain_sides_avg'][:]
+    x = np.arange(len(grain_areas_avg))
+    p = np.polyfit(x, grain_areas_avg, 1)
+    fit_line = np.sum(np.array([p[j]*x*(len(p)-j-1) for j in range(len(p))]), axis=0)
+    s['fit'] = p
+    s['r2'] = np.array(np.corrcoef(grain_areas_avg, fit_line)[0,1]**2)
+    
+    # Number of grains axis for the scaled plots
+    ii = np.argmin(np.abs(grain_areas_avg-lim))
+    s['xs'] = np.linspace(ngrains,int(ngrains*scale_ngrains_ratio),ii)
+    
+    # Normalized radius and number of sides distributions
+    tg = ngrains*frac
+    ng = count_grain_stat_nonzero(g, 'grain_areas')
+    ii = (ng<tg).argmax()
+    ga = grain_areas[ii]
+    gr = np.sqrt(ga/np.pi)
+    bins = np.linspace(0,3,10)
+    gr_dist, _ = np.histogram(gr[gr!=0]/gr[gr!=0].mean(), bins)
+    s['radius_bins'] = bins[:-1]
+    s['radius_dist'] = gr_dist/gr_dist.sum()/bins[1]
+    gs = grain_sides[ii]
+    bins = np.arange(3,9)+0.5
+    gs_dist, _ = np.histogram(gs[gs!=0], bins)
+    s['sides_bins'] = bins[1:]-0.5
+    s['sides_dist'] = gs_dist/gs_dist.sum()
+    
+    return s
+
+
+def find_last_groups(hps):
+    #Name of the last group in each h5 file
+    gps = []
+    for hp in hps:
+        with h5py.File(hp, 'r') as f:
+            gps.append(list(f.keys())[-1])
+            print(f.keys())
+    print('Last groups in each h5 file chosen:')
+    return gps
+
+
+def make_time_plots(hps, ic_shape, sub_folder="", legend = [], gps='last', scale_ngrains_ratio=0.05, cr=None, if_plot=True, num_workers=None):
     # Run "compute_grain_stats" before this function
+    # Each file is opened once, use "process_runs" to compute and cache the statistics of many runs in parallel
     
     #Make 'hps' and 'gps' a list if it isn't already, and set default 'gps'
     if type(hps)!=list: hps = [hps]
     
-    if gps=='last':
-        gps = []
-        for hp in hps:
-            with h5py.File(hp, 'r') as f:
-                gps.append(list(f.keys())[-1])
-                print(f.keys())
-        print('Last groups in each h5 file chosen:')
-        #print(gps)        
+    if gps=='last': gps = find_last_groups(hps)
     else:
         if type(gps)!=list: gps = [gps]
     
-    # Establish color table
-    c = [mcolors.TABLEAU_COLORS[n] for n in list(mcolors.TABLEAU_COLORS)]
-    if np.all(cr!=None): #repeat the the color labels using "cr"
-        tmp = []
-        for i, e in enumerate(c[:len(cr)]): tmp += cr[i]*[e]
-        c = tmp
-    
     # Make sure all needed datasets exist
     #dts=['grain_areas', 'grain_sides', 'ims_miso', 'ims_miso_spparks']
     #check_exist_h5(hps, gps, dts)  
     
-    # Calculate scale limit
-    with h5py.File(hps[0], 'r') as f:
-        g = f[gps[0]]
-        #print(g.keys())
-        total_area = np.prod(g['ims_id'].shape[1:])
-        ngrains = g['grain_areas'].shape[1]
-        lim = total_area/(ngrains*scale_ngrains_ratio)
-    
-    # Plot average grain area through time and find linear slopes
-    log = []
-    ys = []
-    ps = []
-    rs = []
-    for i in tqdm(range(len(hps)),'Calculating avg grain areas'):
+    summaries = []
+    for i in tqdm(range(len(hps)),'Summarizing runs'):
         with h5py.File(hps[i], 'r') as f: 
-            grain_areas_avg = f[gps[i]+'/grain_areas_avg'][:]
-        log.append(grain_areas_avg)
-        
-        x = np.arange(len(grain_areas_avg))
-        p = np.polyfit(x, grain_areas_avg, 1)
-        ps.append(p)
-        
-        fit_line = np.sum(np.array([p[j]*x*(len(p)-j-1) for j in range(len(p))]), axis=0)
-        ys.append(fit_line)
-        
-        r = np.corrcoef(grain_areas_avg, fit_line)[0,1]**2
-        rs.append(r)
+            summaries.append(summarize_run(f[gps[i]], scale_ngrains_ratio))
     
+    plot_summaries(summaries, ic_shape, sub_folder, legend, cr, if_plot, num_workers)
+
+
+def render_figure(spec, if_plot=False):
+    #Draws one figure described by "spec" (from "plot_summaries") and saves it to spec['fp']
+    #spec['lines'] - list of (args, kwargs) for "plt.plot", 'xlim', 'title', 'xlabel', 'ylabel', 'legend' - as in matplotlib
     plt.figure()
-    for i in range(len(hps)):
-        plt.plot(log[i], c=c[i%len(c)])
-        legend.append('Slope: %.3f | R2: %.3f'%(ps[i][0], rs[i]))
-    plt.title('Average grain area')
-    plt.xlabel('Number of frames')
-    plt.ylabel('Average area (pixels)')
-    if legend!= []: plt.legend(legend)
-    plt.savefig('./plots/%s/%s_avg_grain_area_time'%(sub_folder, ic_shape), dpi=300)
-    if if_plot:
-        plt.show()
-        plt.close()
-
-    # Plot scaled average grain area through time and find linear slopes
-    ys = []
-    ps = []
-    rs = []
-    si = []
-    xs = []
-    for i in range(len(hps)):
-        grain_areas_avg = log[i]
-        ii = np.argmin(np.abs(grain_areas_avg-lim))
-        si.append(ii)
-        
-        x = np.arange(len(grain_areas_avg))
-        p = np.polyfit(x, grain_areas_avg, 1)
-        ps.append(p)
-        
-        fit_line = np.sum(np.array([p[j]*x*(len(p)-j-1) for j in range(len(p))]), axis=0)
-        ys.append(fit_line)
-        
-        r = np.corrcoef(grain_areas_avg, fit_line)[0,1]**2
-        rs.append(r)
-        
-        xx = np.linspace(ngrains,int(ngrains*scale_ngrains_ratio),ii)
-        xs.append(xx)
+    for args, kwargs in spec['lines']: plt.plot(*args, **kwargs)
+    if spec['xlim']!=None: plt.xlim(spec['xlim'])
+    plt.title(spec['title'])
+    plt.xlabel(spec['xlabel'])
+    plt.ylabel(spec['ylabel'])
+    if spec['legend']!=[]: plt.legend(spec['legend'])
+    plt.savefig(spec['fp'], dpi=300)
+    if if_plot: plt.show()
+    plt.close()
+
+
+def _render_figure_worker(spec):
+    #Renders one figure in a worker process of "plot_summaries"
+    plt.switch_backend('Agg')
+    render_figure(spec)
+
+
+def plot_summaries(summaries, ic_shape, sub_folder="", legend = [], cr=None, if_plot=True, num_workers=None):
+    #Plots the comparisons made by "make_time_plots" from the outputs of "summarize_run" (or "load_summaries")
+    #Unless shown ("if_plot"), the figures are independent and rendered in a pool of "num_workers" processes
     
-    plt.figure()
-    for i in range(len(hps)):
-        plt.plot(xs[i], log[i][:len(xs[i])], c=c[i%len(c)])
-        plt.xlim([np.max(xs[i]), np.min(xs[i])])
-        legend.append('Slope: %.3f | R2: %.3f'%(ps[i][0], rs[i]))
-    plt.title('Average grain area (scaled)')
-    plt.xlabel('Number of grains')
-    plt.ylabel('Average area (pixels)')
-    if legend!=[]: plt.legend(legend)
-    plt.savefig('./plots/%s/%s_avg_grain_area_time_scaled'%(sub_folder, ic_shape), dpi=300)
-    if if_plot:
-        plt.show()
-        plt.close()
-    
-    # Plot average grain sides through time
-    log = []
-    for i in tqdm(range(len(hps)),'Plotting avg grain sides'):
-        with h5py.File(hps[i], 'r') as f: 
-            grain_sides_avg = f[gps[i]+'/grain_sides_avg'][:]
-        log.append(grain_sides_avg)
+    legend = list(legend) #the slopes are appended below, leave the caller's list alone
     
-    plt.figure()
-    for i in range(len(hps)):
-        plt.plot(log[i], c=c[i%len(c)])
-        legend.append('')
-    plt.title('Average number of grain sides')
-    plt.xlabel('Number of frames')
-    plt.ylabel('Average number of sides')
-    if legend!=[]: plt.legend(legend)
-    plt.savefig('./plots/%s/%s_avg_grain_sides_time'%(sub_folder, ic_shape), dpi=300)
-    if if_plot:
-        plt.show()
-        plt.close()
-        
-    # Plot scaled average grain sides through time
-    plt.figure()
-    for i in range(len(hps)):
-        plt.plot(xs[i], log[i][:len(xs[i])], c=c[i%len(c)])
-        plt.xlim([np.max(xs[i]), np.min(xs[i])])
-        legend.append('')
-    plt.title('Average number of grain sides (scaled)')
-    plt.xlabel('Number of grains')
-    plt.ylabel('Average number of sides')
-    if legend!=[]: plt.legend(legend)
-    plt.savefig('./plots/%s/%s_avg_grain_sides_time_scaled'%(sub_folder, ic_shape), dpi=300)
-    if if_plot:
-        plt.show()
-        plt.close()
-        
-    # Plot grain size distribution
-    plt.figure()
-    frac = 0.25
-    for i in tqdm(range(len(hps)),'Calculating normalized radius distribution'):
-        with h5py.File(hps[i], 'r') as f: 
-            grain_areas = f[gps[i]+'/grain_areas'][:]
-        tg = (grain_areas.shape[1])*frac
-        ng = (grain_areas!=0).sum(1)
-        ii = (ng<tg).argmax()
-        ga = grain_areas[ii]
-        gr = np.sqrt(ga/np.pi)
-        bins=np.linspace(0,3,10)
-        gr_dist, _ = np.histogram(gr[gr!=0]/gr[gr!=0].mean(), bins)
-        plt.plot(bins[:-1], gr_dist/gr_dist.sum()/bins[1])
-    plt.title('Normalized radius distribution (%d%% grains remaining)'%(100*frac))
-    plt.xlabel('R/<R>')
-    plt.ylabel('Frequency')
-    if legend!=[]: plt.legend(legend)
-    plt.savefig('./plots/%s/%s_normalized_radius_distribution'%(sub_folder, ic_shape), dpi=300)
-    if if_plot:
-        plt.show()
-        plt.close()
-    
-    # Plot number of sides distribution
-    plt.figure()
+    # Establish color table
+    c = [mcolors.TABLEAU_COLORS[n] for n in list(mcolors.TABLEAU_COLORS)]
+    if np.all(cr!=None): #repeat the the color labels using "cr"
+        tmp = []
+        for i, e in enumerate(c[:len(cr)]): tmp += cr[i]*[e]
+        c = tmp
+    
+    specs = []
+    def add(lines, xlim, title, xlabel, ylabel, name):
+        fp = './plots/%s/%s_%s'%(sub_folder, ic_shape, name)
+        specs.append({'lines': lines, 'xlim': xlim, 'title': title, 'xlabel': xlabel, 'ylabel': ylabel, 'legend': list(legend), 'fp': fp})
+    
+    # Average grain area through time and linear slopes
+    for s in summaries: legend.append('Slope: %.3f | R2: %.3f'%(s['fit'][0], s['r2']))
+    lines = [((s['grain_areas_avg'],), {'c': c[i%len(c)]}) for i, s in enumerate(summaries)]
+    add(lines, None, 'Average grain area', 'Number of frames', 'Average area (pixels)', 'avg_grain_area_time')
+    
+    # Scaled average grain area through time, the last run sets the limits
+    xlim = [np.max(summaries[-1]['xs']), np.min(summaries[-1]['xs'])]
+    for s in summaries: legend.append('Slope: %.3f | R2: %.3f'%(s['fit'][0], s['r2']))
+    lines = [((s['xs'], s['grain_areas_avg'][:len(s['xs'])]), {'c': c[i%len(c)]}) for i, s in enumerate(summaries)]
+    add(lines, xlim, 'Average grain area (scaled)', 'Number of grains', 'Average area (pixels)', 'avg_grain_area_time_scaled')
+    
+    # Average grain sides through time
+    for s in summaries: legend.append('')
+    lines = [((s['grain_sides_avg'],), {'c': c[i%len(c)]}) for i, s in enumerate(summaries)]
+    add(lines, None, 'Average number of grain sides', 'Number of frames', 'Average number of sides', 'avg_grain_sides_time')
+    
+    # Scaled average grain sides through time
+    for s in summaries: legend.append('')
+    lines = [((s['xs'], s['grain_sides_avg'][:len(s['xs'])]), {'c': c[i%len(c)]}) for i, s in enumerate(summaries)]
+    add(lines, xlim, 'Average number of grain sides (scaled)', 'Number of grains', 'Average number of sides', 'avg_grain_sides_time_scaled')
+    
+    # Grain size distribution
     frac = 0.25
-    for i in tqdm(range(len(hps)),'Calculating number of sides distribution'):
-        with h5py.File(hps[i], 'r') as f: 
-            grain_areas = f[gps[i]+'/grain_areas'][:]
-            grain_sides = f[gps[i]+'/grain_sides'][:]
-        tg = (grain_areas.shape[1])*frac
-        ng = (grain_areas!=0).sum(1)
-        ii = (ng<tg).argmax()
-        gs = grain_sides[ii]
-        bins=np.arange(3,9)+0.5
-        gs_dist, _ = np.histogram(gs[gs!=0], bins)
-        plt.plot(bins[1:]-0.5, gs_dist/gs_dist.sum())
-    plt.title('Number of sides distribution (%d%% grains remaining)'%(100*frac))
-    plt.xlabel('Number of sides')
-    plt.ylabel('Frequency')
-    if legend!=[]: plt.legend(legend)
-    plt.savefig('./plots/%s/%s_number_sides_distribution'%(sub_folder, ic_shape), dpi=300)
-    if if_plot:
-        plt.show()
-        plt.close()
+    lines = [((s['radius_bins'], s['radius_dist']), {}) for s in summaries]
+    add(lines, None, 'Normalized radius distribution (%d%% grains remaining)'%(100*frac), 'R/<R>', 'Frequency', 'normalized_radius_distribution')
+    
+    # Number of sides distribution
+    lines = [((s['sides_bins'], s['sides_dist']), {}) for s in summaries]
+    add(lines, None, 'Number of sides distribution (%d%% grains remaining)'%(100*frac), 'Number of sides', 'Frequency', 'number_sides_distribution')
+    
+    # Render, figures that are shown stay in this process
+    if num_workers==None: num_workers = min(os.cpu_count(), len(specs))
+    if if_plot or num_workers==1: 
+        for spec in specs: render_figure(spec, if_plot)
+    else:
+        with multiprocessing.Pool(num_workers) as pool: pool.map(_render_figure_worker, specs)
+
+
+### Batch post-processing
+def summary_key(hp, gp):
+    #Name of the group of run "hp"/"gp" in a summary file
+    return hashlib.sha1(('%s|%s'%(os.path.abspath(hp), gp)).encode()).hexdigest()
+
+
+def _process_run_worker(inputs):
+    #Computes the statistics and summaries of every group of one file (runs in a worker process of "process_runs")
+    #All groups of a file go to the same worker so each file only has one writer
+    hp, gps, scale_ngrains_ratio, num_threads, kwargs = inputs
+    torch.set_num_threads(num_threads)
+    kwargs = dict(kwargs)
+    kwargs.setdefault('num_workers', num_threads) #defaults that "kwargs" from "process_runs" can override
+    kwargs.setdefault('device', 'cpu')
+    compute_grain_stats([hp]*len(gps), gps, **kwargs)
+    mtime = os.path.getmtime(hp)
+    outputs = []
+    with h5py.File(hp, 'r') as f:
+        for gp in gps: outputs.append((hp, gp, mtime, summarize_run(f[gp], scale_ngrains_ratio)))
+    return outputs
+
+
+def process_runs(hps, gps='last', fp_summary='./data/summary.h5', scale_ngrains_ratio=0.05, num_workers=None, **kwargs):
+    #Computes the statistics of many runs in parallel (one process per file) and caches their summaries in "fp_summary"
+    #Runs already in the summary file are skipped unless their h5 file changed since, the raw trajectories are only read for new runs
+    #"kwargs" - passed to "compute_grain_stats" (e.g. pad_mode, mem_max, if_sparse, device), each worker uses its share of the cores, on the CPU unless "device" is given
+    #Returns the summaries in the order of "hps", plot them with "plot_summaries"
+    
+    #Make 'hps' and 'gps' a list if it isn't already, and set default 'gps'
+    if type(hps)!=list: hps = [hps]
+    if gps=='last': gps = find_last_groups(hps)
+    elif type(gps)!=list: gps = [gps]*len(hps)
+    if num_workers==None: num_workers = os.cpu_count()
+    
+    # Find the runs that are missing or out of date in the summary file
+    todo = {}
+    with h5py.File(fp_summary, 'a') as f:
+        for hp, gp in zip(hps, gps):
+            k = summary_key(hp, gp)
+            if k in f.keys():
+                a = f[k].attrs
+                if a['mtime']==os.path.getmtime(hp) and a['scale_ngrains_ratio']==scale_ngrains_ratio: continue
+            todo.setdefault(hp, []).append(gp)
+    
+    # Compute them, one file per worker, the main process is the only writer of the summary file
+    if len(todo)>0:
+        num_workers = min(num_workers, len(todo))
+        num_threads = max(1, os.cpu_count()//num_workers) #share the cores when there are fewer files than cores
+        inputs = [(hp, todo[hp], scale_ngrains_ratio, num_threads, kwargs) for hp in todo]
+        with multiprocessing.Pool(num_workers) as pool, h5py.File(fp_summary, 'a') as f:
+            for outputs in tqdm(pool.imap_unordered(_process_run_worker, inputs), 'Processing runs', total=len(inputs)):
+                for hp, gp, mtime, s in outputs:
+                    k = summary_key(hp, gp)
+                    if k in f.keys(): del f[k]
+                    g = f.create_group(k)
+                    for n in s: create_h5_dataset(g, n, data=s[n])
+                    g.attrs['hp'] = hp
+                    g.attrs['gp'] = gp
+                    g.attrs['mtime'] = mtime
+                    g.attrs['scale_ngrains_ratio'] = scale_ngrains_ratio
+        print("SUMMARIES WRITTEN TO FILE: %s"%fp_summary)
+    
+    return load_summaries(hps, gps, fp_summary)
+
+
+def load_summaries(hps, gps, fp_summary='./data/summary.h5'):
+    #Reads the summaries of runs "hps"/"gps" written by "process_runs"
+    if type(hps)!=list: hps = [hps]
+    if type(gps)!=list: gps = [gps]*len(hps)
+    summaries = []
+    with h5py.File(fp_summary, 'r') as f:
+        for hp, gp in zip(hps, gps):
+            k = summary_key(hp, gp)
+            if k not in f.keys(): raise Exception('Run not in summary file: %s/%s'%(hp, gp))
+            summaries.append({n: f[k][n][()] for n in f[k].keys()})
+    return summaries
+
 
 def unison_shuffled_copies(a, b):
     assert len(a) == len(b)
@@ -10,7 +10,6 @@ import PRIMME as fsp
 import functions as fs
 import torch
 import argparse
-from pathlib import Path
 
 def main(args):
     # Set device
@@ -25,18 +24,8 @@ def main(args):
     ic_shape = f"{args.grain_shape}({grain_sizes[0][0]}_{grain_sizes[0][1]}_{grain_sizes[1]})" if args.grain_shape != "hex" else "hex"
     
     print(f"IC shape: {ic_shape}")
-    # Define filename for potential saved data
-    filename_test = f"{ic_shape}.pickle"
-    path_load = Path('./data') / filename_test
-    
-    # Load or generate initial conditions and misorientation data
-    if path_load.is_file():
-        print(f"Loading existing initial conditions from {path_load}")
-        data_dict = fs.load_picke_files(load_dir=Path('./data'), filename_save=filename_test)
-        ic, ea, miso_array, miso_matrix = data_dict["ic"], data_dict["ea"], data_dict["miso_array"], data_dict["miso_matrix"]
-    else:
-        print(f"Generating new initial conditions with shape {ic_shape}")
-        ic, ea, miso_array, miso_matrix = fs.generate_train_init(filename_test, args.grain_shape, grain_sizes, device)
+    # Load initial conditions and misorientation data from the cache, or generate them
+    ic, ea, miso_array = fs.load_or_generate_ic(args.grain_shape, grain_sizes, device, seed=args.seed)
     
     # Train or load PRIMME model
     if not args.primme and not args.modelname:
@@ -70,9 +59,10 @@ def main(args):
             nsteps=args.nsteps, 
             modelname=modelname, 
             miso_array=miso_array, 
-            miso_matrix=miso_matrix,
             pad_mode=args.pad_mode, 
-            ic_shape=ic_shape
+            ic_shape=ic_shape,
+            if_delta=args.if_delta,
+            key_freq=args.key_freq
         )
     else:
         print(f"Using existing PRIMME file: {args.primme}")
@@ -119,11 +109,14 @@ if __name__ == "__main__":
     parser.add_argument("--dimension", type=int, default=3, help="Dimension of the image generated by voroni2image.")
     parser.add_argument("--ngrain", type=int, default=2**14, help="Number of grains generated by voroni2image.")
     parser.add_argument("--radius", type=int, default=64, help="Radius of the grains generated by voroni2image.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed used to generate the initial condition.")
 
     # PRIMME Run Related Arguments
     parser.add_argument("--primme", type=str, default=None, help="PRIMME File was provided.")
 
     parser.add_argument("--pad_mode", type=str, default="circular", help="Padding mode.")
+    parser.add_argument("--if_delta", action="store_true", help="Save the trajectory as keyframes plus flipped pixels.")
+    parser.add_argument("--key_freq", type=int, default=10, help="Steps between keyframes when saving with --if_delta.")
     parser.add_argument("--if_output_plot", action="store_true", help="If output plot.")
 
     # Show plots:
@@ -13,7 +13,6 @@ import torch
 import matplotlib.pyplot as plt
 import functions as fs
 import PRIMME
-from pathlib import Path
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "mps" if torch.backends.mps.is_available() else "cpu")
 print(f"Using device: {device}")
@@ -32,22 +31,15 @@ grain_shape = "grain" # Alternatives include "circle", "hex", "square"
 grain_sizes = [[512, 512], 512] # Also tested for 257x257, 1024x1024, 2048x2048, 2400x2400
 ic_shape = f"{grain_shape}({grain_sizes[0][0]}_{grain_sizes[0][1]}_{grain_sizes[1]})" if grain_shape != "hex" else "hex"
 
-# Define filename for potential saved data
-filename_test = f"{ic_shape}.pickle"
-path_load = Path('./data') / filename_test
-
-# Load or generate initial conditions and misorientation data
-if path_load.is_file():
-    data_dict = fs.load_picke_files(load_dir=Path('./data'), filename_save=filename_test)
-    ic, ea, miso_array, miso_matrix = data_dict["ic"], data_dict["ea"], data_dict["miso_array"], data_dict["miso_matrix"]
-else:
-    ic, ea, miso_array, miso_matrix = fs.generate_train_init(filename_test, grain_shape, grain_sizes, device)
+# Load initial conditions and misorientation data from the cache, or generate them
+seed = 0
+ic, ea, miso_array = fs.load_or_generate_ic(grain_shape, grain_sizes, device, seed=seed)
 
 ### Train PRIMME using the above training set from SPPARKS
 model_location = PRIMME.train_primme(trainset, n_step=nsteps, n_samples=200, mode="Single_Step", num_eps=100, dims=2, obs_dim=17, act_dim=17, lr=5e-5, reg=1, pad_mode="circular", if_plot=False)
 
 # Run PRIMME model
-ims_id, fp_primme = PRIMME.run_primme(ic, ea, miso_array, miso_matrix, nsteps=nsteps, ic_shape=ic_shape, modelname=model_location, pad_mode='circular', if_plot=False)
+ims_id, fp_primme = PRIMME.run_primme(ic, ea, miso_array, nsteps=nsteps, ic_shape=ic_shape, modelname=model_location, pad_mode='circular', if_plot=False)
 
 # Generate plots
 fs.compute_grain_stats(fp_primme)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Checks that "create_trainset" writes the same sets whatever the number of workers and when resumed after an interruption
+Uses "fs.StandInSimulator", so SPPARKS is not needed
+"""
+
+# IMPORT PACKAGES
+
+import os
+import h5py
+import numpy as np
+import functions as fs
+
+fp_full = './data/trainset_check_full.h5'
+fp_resumed = './data/trainset_check_resumed.h5'
+params = dict(size=[64,64], ngrains_rng=[32,64], nsets=8, max_steps=20, offset_steps=1, future_steps=4, seed=0, path_sim='./trainset_check')
+for fp in [fp_full, fp_resumed]: 
+    if os.path.exists(fp): os.remove(fp)
+
+# Uninterrupted, one worker
+fs.create_trainset(fs.StandInSimulator(), fp_full, num_workers=1, **params)
+
+# Interrupted after half of the sets (the sets after it were never written or marked done), then resumed with several workers
+fs.create_trainset(fs.StandInSimulator(), fp_resumed, num_workers=4, **params)
+with h5py.File(fp_resumed, 'a') as f:
+    f['done'][4:] = False
+    for k in ['ims_id', 'ims_energy', 'euler_angles']: f[k][4:] = 0
+fs.create_trainset(fs.StandInSimulator(), fp_resumed, num_workers=4, **params)
+
+# Compare, fails on any set that was not reproduced
+try:
+    with h5py.File(fp_full, 'r') as f1, h5py.File(fp_resumed, 'r') as f2:
+        assert f1['done'][:].all() and f2['done'][:].all(), 'Not every set was written'
+        for k in ['ims_id', 'ims_energy', 'euler_angles']: 
+            assert np.array_equal(f1[k][:], f2[k][:]), '"%s" differs after resume'%k
+finally:
+    for fp in [fp_full, fp_resumed]: os.remove(fp)
+print("SETS REPRODUCED AFTER RESUME")